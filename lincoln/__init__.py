@@ -7,16 +7,16 @@ import logging
 import inspect
 
 from flask import Flask, current_app
-from flask.ext.sqlalchemy import SQLAlchemy
 from flask.ext.migrate import Migrate
 from werkzeug.local import LocalProxy
 from bitcoin.rpc import Proxy
-from redis import Redis
 
 import lincoln.filters as filters
+from lincoln.routing import RoutingSQLAlchemy, ReplicaRouter
+from lincoln import serving
 
 root = os.path.abspath(os.path.dirname(__file__) + '/../')
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
 
 coinserv = LocalProxy(
     lambda: getattr(current_app, 'rpc_connection', None))
@@ -38,6 +38,8 @@ def create_app(log_level="INFO", config="/config.yml", global_config="/global.ym
 
     config_vars = yaml.load(open(root + config))
     app.config.update(config_vars)
+    # Kept so benchmarks can start servers with the same config
+    app.config_path = config
 
     # set our template paths
     custom_template_path = app.config.get('custom_template_path', 'lincoln/custom_templates')
@@ -51,6 +53,11 @@ def create_app(log_level="INFO", config="/config.yml", global_config="/global.ym
     db.init_app(app)
     Migrate(app, db)
 
+    # Web views read from replicas when any are configured
+    replicas = app.config.get('replica_database_uris')
+    if replicas:
+        app.replica_router = ReplicaRouter(app, db, replicas)
+
     # Setup redis
     redis_config = app.config.get('redis_conn', dict(type='live'))
     typ = redis_config.pop('type')
@@ -58,7 +65,10 @@ def create_app(log_level="INFO", config="/config.yml", global_config="/global.ym
         from mockredis import mock_redis_client
         app.redis = mock_redis_client()
     else:
-        app.redis = Redis(**redis_config)
+        app.redis = serving.redis_client(app, redis_config)
+
+    # Connection pools, statement timeouts and gevent support for serving
+    serving.init_app(app)
 
     del app.logger.handlers[0]
     app.logger.setLevel(logging.NOTSET)
@@ -93,6 +103,11 @@ def create_app(log_level="INFO", config="/config.yml", global_config="/global.ym
                 app.config['coinserv']['address'],
                 app.config['coinserv']['port']))
 
+    # Opt in per-request query and render timing for the web views
+    if app.config.get('profile_requests'):
+        from . import profiling
+        profiling.init_app(app)
+
     from . import views
     app.register_blueprint(views.main)
     return app
@@ -0,0 +1,309 @@
+""" Rechecks the totals sync caches on transactions, blocks and addresses
+against the outputs they're derived from. Each kind is split into ranges of
+ids that worker processes recompute in parallel, one bounded set of grouped
+queries per range, so no query ever aggregates a whole table. Progress is
+checkpointed in redis as ranges complete, and an interrupted audit resumes
+from there.
+
+Sync keeps running meanwhile. A range is read in one snapshot on postgres,
+transactions and blocks are only checked up to `audit_margin` blocks below
+the tip, and repairs lock the rows they fix and recompute them first, so a
+block committed mid-audit isn't mistaken for drift. """
+import multiprocessing
+import time
+from decimal import Decimal
+
+import sqlalchemy
+from flask import current_app
+from redis.exceptions import RedisError
+
+from . import db, redis_conn, cache, pruning, richlist
+from .models import (Block, Transaction, Address, Output, OutputArchive,
+                     OutputArchiveAddress)
+
+KINDS = ('transaction', 'block', 'address')
+# Mismatches reported per range, the rest are only counted
+REPORT_LIMIT = 20
+
+
+def satoshis(column):
+    # Sum whole satoshis, since SQLite would otherwise sum the amount
+    # strings as floats. The cast is because SqliteNumeric can't take part
+    # in arithmetic once it's been used with SQLite
+    amount = sqlalchemy.cast(column, sqlalchemy.Numeric)
+    return sqlalchemy.func.sum(sqlalchemy.cast(
+        sqlalchemy.func.round(amount * 100000000), sqlalchemy.BigInteger))
+
+
+def _to_satoshis(amount):
+    return int((amount or 0) * 100000000)
+
+
+def transaction_totals(where):
+    """ {tx id: {total_in, total_out}} recomputed from outputs, including any
+    that pruning has moved to the archive """
+    totals = {}
+    for tx_id, total in (db.session.query(Transaction.id, satoshis(Output.amount))
+                         .join(Output, Output.origin_tx_hash == Transaction.txid)
+                         .filter(where(Transaction.id))
+                         .group_by(Transaction.id)):
+        totals.setdefault(tx_id, {})['total_out'] = int(total)
+    for tx_id, total in (db.session.query(Output.spend_tx_id, satoshis(Output.amount))
+                         .filter(where(Output.spend_tx_id))
+                         .group_by(Output.spend_tx_id)):
+        totals.setdefault(tx_id, {})['total_in'] = int(total)
+    for archive in OutputArchive.query.filter(where(OutputArchive.tx_id)):
+        t = totals.setdefault(archive.tx_id, {})
+        for field, blob in (('total_out', archive.created),
+                            ('total_in', archive.spent)):
+            t[field] = t.get(field, 0) + sum(
+                _to_satoshis(amount) for _, _, amount, _, _ in pruning.unpack(blob))
+    return totals
+
+
+def block_totals(where):
+    """ {height: {total_in, total_out}} summed from the block's transactions """
+    return dict((height, dict(total_in=int(total_in or 0),
+                              total_out=int(total_out or 0)))
+                for height, total_in, total_out in
+                db.session.query(Transaction.height,
+                                 satoshis(Transaction.total_in),
+                                 satoshis(Transaction.total_out))
+                .filter(where(Transaction.height))
+                .group_by(Transaction.height))
+
+
+def address_totals(where):
+    """ {address id: {total_in, total_out, balance}} summed from outputs,
+    including any that pruning has moved to the archive """
+    totals = {}
+    spent = Output.spend_tx_id.isnot(None)
+    for address_id, total_in, total_out in (
+            db.session.query(Address.id, satoshis(Output.amount),
+                             satoshis(sqlalchemy.case([(spent, Output.amount)],
+                                                      else_=0)))
+            .join(Output, Output.address_hash == Address.hash)
+            .filter(where(Address.id))
+            .group_by(Address.id)):
+        totals[address_id] = dict(total_in=int(total_in),
+                                  total_out=int(total_out))
+
+    # Archived outputs were all spent, so count toward both totals
+    ids = dict(db.session.query(Address.hash, Address.id)
+               .filter(where(Address.id)))
+    hashes = list(ids)
+    tx_ids = set()
+    for i in range(0, len(hashes), pruning.IN_CHUNK):
+        tx_ids.update(
+            tx_id for tx_id, in db.session.query(OutputArchiveAddress.tx_id)
+            .filter(OutputArchiveAddress.address_hash.in_(
+                hashes[i:i + pruning.IN_CHUNK])))
+    tx_ids = sorted(tx_ids)
+    for i in range(0, len(tx_ids), pruning.IN_CHUNK):
+        for archive in OutputArchive.query.filter(
+                OutputArchive.tx_id.in_(tx_ids[i:i + pruning.IN_CHUNK])):
+            for _, _, amount, address_hash, _ in pruning.unpack(archive.created):
+                if address_hash not in ids:
+                    continue
+                t = totals.setdefault(ids[address_hash],
+                                      dict(total_in=0, total_out=0))
+                t['total_in'] += _to_satoshis(amount)
+                t['total_out'] += _to_satoshis(amount)
+
+    for t in totals.values():
+        t['balance'] = t['total_in'] - t['total_out']
+    return totals
+
+
+def between(low, high):
+    return lambda column: column.between(low, high)
+
+
+def among(keys):
+    return lambda column: column.in_(keys)
+
+
+class Check(object):
+    """ How to read, recompute and fix the cached totals of one table """
+
+    def __init__(self, model, key, fields, compute):
+        self.model = model
+        self.key = key
+        self.fields = fields
+        self.compute = compute
+
+    def stored(self, where, lock=False):
+        query = self.model.query.filter(where(self.key))
+        if lock:
+            query = query.with_for_update()
+        return dict((getattr(row, self.key.key), row) for row in query)
+
+    def values(self, row):
+        values = {}
+        for field in self.fields:
+            if field == 'balance':
+                values[field] = row.balance_satoshis
+            else:
+                values[field] = _to_satoshis(getattr(row, field))
+        return values
+
+    def mismatches(self, stored, computed):
+        empty = dict((field, 0) for field in self.fields)
+        found = []
+        for key, row in sorted(stored.items()):
+            have = self.values(row)
+            want = dict(empty, **computed.get(key, {}))
+            for field in self.fields:
+                if have[field] != want[field]:
+                    found.append((key, field, have[field], want[field]))
+        return found
+
+    def repair(self, found):
+        """ Locks the rows, which waits out a sync holding them, and fixes
+        them from totals recomputed under the lock. The recompute's queries
+        aren't one snapshot, so one straddling a prune step can count an
+        output both live and archived. A fix is only written where it agrees
+        with the value `found` from the audit's snapshot """
+        wanted = dict(((key, field), want) for key, field, _, want in found)
+        keys = sorted(set(key for key, _ in wanted))
+        fixed = 0
+        for i in range(0, len(keys), pruning.IN_CHUNK):
+            where = among(keys[i:i + pruning.IN_CHUNK])
+            stored = self.stored(where, lock=True)
+            for key, field, have, want in self.mismatches(stored, self.compute(where)):
+                if wanted.get((key, field)) != want:
+                    current_app.logger.warn(
+                        "{} {} {} changed during the audit, leaving it for the "
+                        "next pass".format(self.model.__name__, key, field))
+                    continue
+                row = stored[key]
+                if field == 'balance':
+                    row.balance_satoshis = want
+                else:
+                    setattr(row, field, Decimal(want) / 100000000)
+                fixed += 1
+            db.session.commit()
+        return fixed
+
+
+CHECKS = {
+    'transaction': Check(Transaction, Transaction.id,
+                         ('total_in', 'total_out'), transaction_totals),
+    'block': Check(Block, Block.height, ('total_in', 'total_out'), block_totals),
+    'address': Check(Address, Address.id,
+                     ('total_in', 'total_out', 'balance'), address_totals),
+}
+
+
+def audit_range(kind, low, high, repair=False):
+    """ Checks the rows of one kind with keys from `low` through `high` """
+    check = CHECKS[kind]
+    where = between(low, high)
+    if db.engine.dialect.name == 'postgresql':
+        # Read the stored and recomputed totals from the same snapshot
+        db.session.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+    stored = check.stored(where)
+    found = check.mismatches(stored, check.compute(where))
+    db.session.rollback()
+
+    fixed = 0
+    if repair and found:
+        fixed = check.repair(found)
+    return dict(kind=kind, low=low, high=high, checked=len(stored),
+                mismatches=len(found), repaired=fixed,
+                examples=found[:REPORT_LIMIT])
+
+
+def key_range(kind, safe_height):
+    """ Lowest and highest key worth auditing for a kind """
+    if kind == 'block':
+        return 0, safe_height
+    if kind == 'transaction':
+        # Ids grow with height, since rollbacks only ever delete from the
+        # top, so the safe block's transactions hold the highest safe id
+        return 1, (db.session.query(sqlalchemy.func.max(Transaction.id))
+                   .filter(Transaction.height == safe_height).scalar()) or 0
+    return 1, db.session.query(sqlalchemy.func.max(Address.id)).scalar() or 0
+
+
+def checkpoint_key(kind):
+    return cache.key('audit:' + kind)
+
+
+def checkpoint(kind):
+    try:
+        value = redis_conn.get(checkpoint_key(kind))
+    except RedisError:
+        return None
+    return int(value) if value is not None else None
+
+
+def set_checkpoint(kind, value):
+    try:
+        if value is None:
+            redis_conn.delete(checkpoint_key(kind))
+        else:
+            redis_conn.set(checkpoint_key(kind), value)
+    except RedisError:
+        current_app.logger.warn("Unable to record audit progress", exc_info=True)
+
+
+_worker = {}
+
+
+def _init_worker(app, sleep):
+    ctx = app.app_context()
+    ctx.push()
+    _worker.update(ctx=ctx, sleep=sleep)
+
+
+def _run_range(args):
+    try:
+        return audit_range(*args)
+    finally:
+        db.session.remove()
+        if _worker.get('sleep'):
+            time.sleep(_worker['sleep'])
+
+
+def run(kinds=KINDS, workers=4, chunk_size=10000, repair=False, sleep=0,
+        restart=False, report=None):
+    """ Audits each kind in turn, calling `report` with the result of every
+    range. Returns the summed results per kind """
+    highest = Block.query.order_by(Block.height.desc()).first()
+    if highest is None:
+        return {}
+    margin = int(current_app.config.get('audit_margin', 10))
+    safe_height = highest.height - margin
+    summary = {}
+
+    app = current_app._get_current_object()
+    # Children must open their own connections rather than share ours
+    db.session.remove()
+    db.engine.dispose()
+    ctx = multiprocessing.get_context('fork')
+    pool = ctx.Pool(workers, initializer=_init_worker, initargs=(app, sleep))
+    try:
+        for kind in kinds:
+            low, high = key_range(kind, safe_height)
+            done = None if restart else checkpoint(kind)
+            if done is not None:
+                low = done + 1
+            ranges = [(kind, start, min(start + chunk_size - 1, high), repair)
+                      for start in range(low, high + 1, chunk_size)]
+            totals = summary[kind] = dict(checked=0, mismatches=0, repaired=0)
+            # In order, so the checkpoint only ever covers finished ranges
+            for result in pool.imap(_run_range, ranges):
+                for k in totals:
+                    totals[k] += result[k]
+                set_checkpoint(kind, result['high'])
+                if report is not None:
+                    report(result)
+            # A finished pass starts over next time
+            set_checkpoint(kind, None)
+            if kind == 'address' and totals['repaired']:
+                richlist.rebuild_buckets()
+    finally:
+        pool.close()
+        pool.join()
+    return summary
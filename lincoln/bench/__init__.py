@@ -0,0 +1,26 @@
+""" Benchmark harnesses, run through the bench_* commands in manage.py """
+import time
+
+
+def percentile(samples, pct):
+    """ Nearest rank percentile of a list of samples """
+    if not samples:
+        return 0
+    ordered = sorted(samples)
+    rank = int(round(pct / 100.0 * (len(ordered) - 1)))
+    return ordered[rank]
+
+
+def rate(count, seconds):
+    return count / seconds if seconds else float('inf')
+
+
+class Timer(object):
+    """ Context manager that records elapsed wall time in `elapsed` """
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, ty, val, tb):
+        self.elapsed = time.time() - self.start
+        return False
@@ -0,0 +1,130 @@
+import random
+
+from bitcoin.core import (CBlock, CTransaction, CTxIn, CTxOut, COutPoint,
+                          COIN)
+import bitcoin.core.script as op
+
+# Relative weights of the script types generated for outputs
+DEFAULT_SCRIPT_MIX = {'p2pkh': 70, 'p2sh': 20, 'p2pk': 5, 'non-std': 5}
+
+
+class ChainGenerator(object):
+    """ Deterministically builds a synthetic chain of CBlock objects. Every
+    count is drawn uniformly from an inclusive (min, max) range, so the same
+    seed and settings always produce byte identical blocks """
+
+    def __init__(self, seed=1, txs_per_block=(1, 50), inputs_per_tx=(1, 3),
+                 outputs_per_tx=(1, 4), script_mix=None, address_reuse=0.3,
+                 start_time=1317972665, block_interval=150, nbits=0x1e0ffff0):
+        self.rng = random.Random(seed)
+        self.txs_per_block = txs_per_block
+        self.inputs_per_tx = inputs_per_tx
+        self.outputs_per_tx = outputs_per_tx
+        mix = sorted((script_mix or DEFAULT_SCRIPT_MIX).items())
+        self.script_types = [t for t, _ in mix]
+        self.script_weights = [w for _, w in mix]
+        self.address_reuse = address_reuse
+        self.start_time = start_time
+        self.block_interval = block_interval
+        self.nbits = nbits
+
+        self.utxos = []
+        # Address pools per script type. Lincoln keys addresses by hash alone,
+        # so a hash reused across script types would collide
+        self.addresses = {}
+        self.prev_hash = b'\x00' * 32
+        self.height = 0
+
+    def _randrange(self, bounds):
+        return self.rng.randint(*bounds)
+
+    def _random_bytes(self, length):
+        return bytes(self.rng.getrandbits(8) for _ in range(length))
+
+    def _address(self, script_type, length):
+        pool = self.addresses.setdefault(script_type, [])
+        if pool and self.rng.random() < self.address_reuse:
+            return self.rng.choice(pool)
+        addr = self._random_bytes(length)
+        pool.append(addr)
+        return addr
+
+    def _script(self, script_type=None):
+        if script_type is None:
+            script_type = self._weighted_type()
+        if script_type == 'p2pkh':
+            return op.CScript([op.OP_DUP, op.OP_HASH160,
+                               self._address(script_type, 20),
+                               op.OP_EQUALVERIFY, op.OP_CHECKSIG])
+        if script_type == 'p2sh':
+            return op.CScript([op.OP_HASH160, self._address(script_type, 20),
+                               op.OP_EQUAL])
+        if script_type == 'p2pk':
+            return op.CScript([b'\x02' + self._address(script_type, 32),
+                               op.OP_CHECKSIG])
+        return op.CScript([op.OP_RETURN, self._random_bytes(8)])
+
+    def _weighted_type(self):
+        pick = self.rng.uniform(0, sum(self.script_weights))
+        for script_type, weight in zip(self.script_types, self.script_weights):
+            pick -= weight
+            if pick <= 0:
+                return script_type
+        return self.script_types[-1]
+
+    def _take_utxo(self):
+        # Swap remove keeps picking a random coin O(1)
+        i = self.rng.randrange(len(self.utxos))
+        self.utxos[i], self.utxos[-1] = self.utxos[-1], self.utxos[i]
+        return self.utxos.pop()
+
+    def _add_outputs(self, tx):
+        txid = tx.GetHash()
+        for i, txout in enumerate(tx.vout):
+            if txout.nValue > 0:
+                self.utxos.append((COutPoint(txid, i), txout.nValue))
+
+    def _coinbase(self):
+        script_sig = op.CScript([self.height, b'lincoln-bench'])
+        return CTransaction([CTxIn(COutPoint(), script_sig)],
+                            [CTxOut(50 * COIN, self._script('p2pkh'))])
+
+    def _spend(self):
+        count = min(self._randrange(self.inputs_per_tx), len(self.utxos))
+        coins = [self._take_utxo() for _ in range(count)]
+        value = sum(v for _, v in coins)
+        vin = [CTxIn(outpoint, op.CScript([self._random_bytes(72)]))
+               for outpoint, _ in coins]
+
+        n_out = self._randrange(self.outputs_per_tx)
+        vout = []
+        for _ in range(n_out):
+            script_type = self._weighted_type()
+            # Non-standard outputs are data carriers and never get spent
+            amount = 0 if script_type == 'non-std' else value // (n_out + 1)
+            vout.append(CTxOut(amount, self._script(script_type)))
+        return CTransaction(vin, vout)
+
+    def next_block(self):
+        vtx = [self._coinbase()]
+        self._add_outputs(vtx[0])
+        for _ in range(self._randrange(self.txs_per_block) - 1):
+            if not self.utxos:
+                break
+            tx = self._spend()
+            vtx.append(tx)
+            self._add_outputs(tx)
+
+        block = CBlock(hashPrevBlock=self.prev_hash,
+                       hashMerkleRoot=CBlock.build_merkle_tree_from_txs(vtx)[-1],
+                       nTime=self.start_time + self.height * self.block_interval,
+                       nBits=self.nbits,
+                       nNonce=self.height,
+                       vtx=vtx)
+        self.prev_hash = block.GetHash()
+        self.height += 1
+        return block
+
+    def blocks(self, count):
+        for _ in range(count):
+            yield self.next_block()
@@ -0,0 +1,30 @@
+from flask import current_app
+
+from lincoln import cache, db
+from lincoln.bench import Timer, rate
+
+
+def run(requests=500):
+    """ Compares requests/sec for the front page served from the redis ring
+    of recent blocks against the plain ORDER BY height query """
+    app = current_app._get_current_object()
+    client = app.test_client()
+    ring_size = cache.ring_size()
+    results = {}
+
+    for name, size in (('sql', 0), ('ring', ring_size or 100)):
+        app.config['block_ring_size'] = size
+        if size:
+            cache.rebuild_block_ring()
+        # Warm up template compilation and connection pools
+        client.get('/')
+        with Timer() as t:
+            for _ in range(requests):
+                client.get('/')
+                # Commands run in an app context, so requests don't tear down
+                # the session on their own
+                db.session.remove()
+        results[name] = rate(requests, t.elapsed)
+
+    app.config['block_ring_size'] = ring_size
+    return results
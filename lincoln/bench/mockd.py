@@ -0,0 +1,100 @@
+import json
+import os
+import socketserver
+from binascii import hexlify
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from bitcoin.core import b2lx
+
+from lincoln import blkfile
+from lincoln.bench.chain import ChainGenerator
+
+
+class MockCoinDaemon(object):
+    """ Serves a pre-generated chain through the subset of the coin daemon's
+    JSON-RPC interface that sync uses. Blocks are kept serialized, so a long
+    chain costs roughly its raw size in memory """
+
+    def __init__(self, blocks):
+        self.hashes = []
+        self.raw = {}
+        for block in blocks:
+            block_hash = b2lx(block.GetHash())
+            self.hashes.append(block_hash)
+            self.raw[block_hash] = hexlify(block.serialize()).decode('ascii')
+
+    def getblockcount(self):
+        return len(self.hashes) - 1
+
+    def getblockhash(self, height):
+        if not 0 <= height < len(self.hashes):
+            raise RPCError(-8, "Block height out of range")
+        return self.hashes[height]
+
+    def getblock(self, block_hash, verbose=True):
+        if block_hash not in self.raw:
+            raise RPCError(-5, "Block not found")
+        if verbose:
+            raise RPCError(-32601, "Only raw blocks are served")
+        return self.raw[block_hash]
+
+    def dispatch(self, request):
+        method = getattr(self, request.get('method', ''), None)
+        if method is None or request['method'] not in ('getblockcount',
+                                                       'getblockhash',
+                                                       'getblock'):
+            raise RPCError(-32601, "Method not found")
+        return method(*request.get('params', []))
+
+
+class RPCError(Exception):
+    def __init__(self, code, message):
+        Exception.__init__(self, message)
+        self.code = code
+        self.message = message
+
+
+class RPCHandler(BaseHTTPRequestHandler):
+    # bitcoin.rpc.Proxy keeps one connection open for the whole sync
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(
+            int(self.headers['Content-Length'])).decode('utf8'))
+        response = {'id': request.get('id'), 'result': None, 'error': None}
+        try:
+            response['result'] = self.server.coin_daemon.dispatch(request)
+        except RPCError as e:
+            response['error'] = {'code': e.code, 'message': e.message}
+
+        body = json.dumps(response).encode('utf8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class RPCServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve(port, block_count, ready=None, blocks_dir=None, magic=None,
+          **chain_options):
+    """ Generates a chain and serves it until killed. Meant to be the target
+    of a separate process, so that generating and serving the chain doesn't
+    skew the memory and CPU numbers of the process being measured. With
+    blocks_dir the chain is also written out as a blk*.dat file """
+    generator = ChainGenerator(**chain_options)
+    blocks = list(generator.blocks(block_count))
+    if blocks_dir is not None:
+        blkfile.write_blocks(os.path.join(blocks_dir, 'blk00000.dat'),
+                             blocks, magic)
+    server = RPCServer(('127.0.0.1', port), RPCHandler)
+    server.coin_daemon = MockCoinDaemon(blocks)
+    if ready is not None:
+        ready.set()
+    server.serve_forever()
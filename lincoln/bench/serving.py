@@ -0,0 +1,108 @@
+import http.client
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+from lincoln import root
+from lincoln.bench import percentile, rate
+from lincoln.bench.sync import free_port
+
+
+def _wait_for_port(port, proc, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError("gunicorn exited during startup")
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError("gunicorn didn't start listening within {}s".format(timeout))
+
+
+def _client(port, paths, deadline, latencies, errors):
+    """ One simulated user issuing requests back to back over a keep-alive
+    connection, reconnecting after any failure """
+    conn = None
+    i = 0
+    while time.time() < deadline:
+        path = paths[i % len(paths)]
+        i += 1
+        start = time.time()
+        try:
+            if conn is None:
+                conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+            conn.request('GET', path)
+            response = conn.getresponse()
+            response.read()
+            if response.status != 200:
+                errors.append(response.status)
+                continue
+        except (OSError, http.client.HTTPException):
+            errors.append('connection')
+            if conn is not None:
+                conn.close()
+            conn = None
+            continue
+        latencies.append(time.time() - start)
+    if conn is not None:
+        conn.close()
+
+
+def load(port, paths, concurrency, duration):
+    latencies = []
+    errors = []
+    deadline = time.time() + duration
+    threads = [threading.Thread(target=_client,
+                                args=(port, paths, deadline, latencies, errors))
+               for _ in range(concurrency)]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+    return dict(requests=len(latencies),
+                errors=len(errors),
+                requests_per_sec=rate(len(latencies), elapsed),
+                p50_ms=percentile(latencies, 50) * 1000 if latencies else 0,
+                p99_ms=percentile(latencies, 99) * 1000 if latencies else 0)
+
+
+def run(config, worker_classes=('sync', 'gevent'), worker_counts=(1, 2, 4),
+        concurrency=100, duration=10, paths=('/',), connections=1000):
+    """ Serves the app with gunicorn once per worker class and worker count,
+    drives it with `concurrency` clients for `duration` seconds and reports
+    throughput and latency. `config` is the path create_app loads """
+    reports = []
+    for worker_class in worker_classes:
+        for workers in worker_counts:
+            port = free_port()
+            app = "lincoln.wsgi_entry:create_app(config={!r})".format(config)
+            args = [sys.executable, '-c',
+                    'from gunicorn.app.wsgiapp import run; run()',
+                    '--bind', '127.0.0.1:{}'.format(port),
+                    '--workers', str(workers),
+                    '--worker-class', worker_class,
+                    '--worker-connections', str(connections),
+                    '--timeout', '270',
+                    '--log-level', 'warning',
+                    app]
+            env = dict(os.environ, PYTHONPATH=root)
+            proc = subprocess.Popen(args, cwd=root, env=env)
+            try:
+                _wait_for_port(port, proc)
+                # Let every worker come up and warm its templates
+                load(port, paths, workers * 2, 1)
+                report = load(port, paths, concurrency, duration)
+            finally:
+                proc.terminate()
+                proc.wait()
+            report.update(worker_class=worker_class, workers=workers,
+                          concurrency=concurrency)
+            reports.append(report)
+    return reports
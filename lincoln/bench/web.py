@@ -0,0 +1,254 @@
+import datetime
+import random
+from decimal import Decimal
+
+import sqlalchemy
+from bitcoin.core import b2lx
+from flask import current_app
+
+from lincoln import db, cache, partitioning
+from lincoln.bench import Timer, percentile
+from lincoln.models import Block, Transaction, Output, Address
+from lincoln.utils import address_str
+
+# Output.index is a SmallInteger
+MAX_TX_OUTPUTS = 32767
+
+
+class Populator(object):
+    """ Bulk loads a large synthetic explorer database with plain Core
+    inserts, far faster than syncing an equivalent chain. Besides ordinary
+    rows it plants a few pathological cases: a whale address that receives
+    a large share of all outputs, a transaction with a huge number of
+    outputs, and a block with a huge number of transactions """
+
+    def __init__(self, outputs=1000000, txs_per_block=200, outputs_per_tx=(1, 4),
+                 addresses=100000, whale_share=0.05, huge_tx_outputs=30000,
+                 huge_block_txs=20000, spent_share=0.7, seed=1, chunk_size=10000):
+        self.rng = random.Random(seed)
+        self.outputs = outputs
+        self.txs_per_block = txs_per_block
+        self.outputs_per_tx = outputs_per_tx
+        self.address_count = addresses
+        self.whale_share = whale_share
+        self.huge_tx_outputs = min(huge_tx_outputs, MAX_TX_OUTPUTS)
+        self.huge_block_txs = huge_block_txs
+        self.spent_share = spent_share
+        self.chunk_size = chunk_size
+        self.huge_block_height = 10
+        self.huge_tx_height = 20
+
+        self.currency = current_app.config['currency']
+        self.version = self.currency['p2pkh_address_version']
+        self.pending = {}
+
+    def _hash(self, length=32):
+        return bytes(self.rng.getrandbits(8) for _ in range(length))
+
+    def _insert(self, table, row):
+        rows = self.pending.setdefault(table, [])
+        rows.append(row)
+        if len(rows) >= self.chunk_size:
+            self._flush()
+
+    def _flush(self):
+        # Parents first, so foreign keys hold on postgres
+        for table in (Block.__table__, Transaction.__table__,
+                      Address.__table__, Output.__table__):
+            rows = self.pending.pop(table, None)
+            if rows:
+                db.session.execute(table.insert(), rows)
+
+    def _tx_sizes(self):
+        """ Yields (block height, [outputs per tx]) until the output budget is
+        spent. The huge block and huge transaction are always planted """
+        remaining = self.outputs
+        height = 0
+        while remaining > 0 or height <= self.huge_tx_height:
+            if height == self.huge_block_height:
+                count = self.huge_block_txs
+            else:
+                count = self.txs_per_block
+            sizes = [self.rng.randint(*self.outputs_per_tx) for _ in range(count)]
+            if height == self.huge_tx_height:
+                sizes[-1] = self.huge_tx_outputs
+            remaining -= sum(sizes)
+            yield height, sizes
+            height += 1
+
+    def run(self):
+        db.session.commit()
+        db.drop_all()
+        db.create_all()
+
+        start = datetime.datetime(2014, 1, 1)
+        address_hashes = [self._hash(20) for _ in range(self.address_count)]
+        whale = address_hashes[0]
+        totals = dict((h, [Decimal(0), Decimal(0)]) for h in address_hashes)
+        for i, h in enumerate(address_hashes):
+            self._insert(Address.__table__, dict(
+                id=i + 1, hash=h, version=self.version,
+                currency=self.currency['code'], total_in=0, total_out=0,
+                first_seen_at=start))
+
+        tx_id = 0
+        samples = {}
+        for height, sizes in self._tx_sizes():
+            # Build the whole block in memory first, since its row needs
+            # totals and has to be inserted ahead of its transactions
+            txs = []
+            block_total = Decimal(0)
+            ntime = start + datetime.timedelta(seconds=150 * height)
+            for tx_outputs in sizes:
+                tx_id += 1
+                txid = self._hash()
+                outputs = []
+                for index in range(tx_outputs):
+                    if self.rng.random() < self.whale_share:
+                        addr = whale
+                    else:
+                        addr = self.rng.choice(address_hashes)
+                    amount = Decimal(self.rng.randint(1, 10 ** 9)) / 100000000
+                    spent = self.rng.random() < self.spent_share
+                    totals[addr][0] += amount
+                    if spent:
+                        totals[addr][1] += amount
+                    outputs.append(dict(
+                        type=1, origin_tx_hash=txid, height=height,
+                        index=index, amount=amount,
+                        address_hash=addr,
+                        # Spent by some earlier tx, since later ones don't exist yet
+                        spend_tx_id=self.rng.randint(1, tx_id) if spent else None))
+                tx_total = sum(o['amount'] for o in outputs)
+                block_total += tx_total
+                txs.append((dict(id=tx_id, txid=txid, block_id=height + 1,
+                                 height=height, ntime=ntime,
+                                 coinbase=not txs, total_in=tx_total,
+                                 total_out=tx_total), outputs))
+                if height == self.huge_tx_height and len(txs) == len(sizes):
+                    samples['huge_tx'] = txid
+                else:
+                    samples['tx'] = txid
+
+            partitioning.ensure_partitions(db.engine, db.metadata, height)
+            block_hash = self._hash()
+            self._insert(Block.__table__, dict(
+                id=height + 1, hash=block_hash, height=height, ntime=ntime,
+                orphan=False, total_in=block_total, total_out=block_total,
+                difficulty=1000.0 + height, currency=self.currency['code'],
+                algo=current_app.config['algo']['display']))
+            for tx, outputs in txs:
+                self._insert(Transaction.__table__, tx)
+                for output in outputs:
+                    self._insert(Output.__table__, output)
+            if height == self.huge_block_height:
+                samples['huge_block'] = block_hash
+            samples['block'] = block_hash
+        self._flush()
+
+        address_table = Address.__table__
+        db.session.execute(
+            address_table.update()
+            .where(address_table.c.hash == sqlalchemy.bindparam('addr'))
+            .values(total_in=sqlalchemy.bindparam('total_in'),
+                    total_out=sqlalchemy.bindparam('total_out')),
+            [dict(addr=h, total_in=t[0], total_out=t[1])
+             for h, t in totals.items()])
+        db.session.commit()
+
+        samples['whale'] = whale
+        samples['address'] = address_hashes[-1]
+        samples['middle_height'] = height // 2
+        return samples
+
+
+def routes(samples, version):
+    """ The urls to measure, named after what makes each one interesting """
+    return [
+        ('front page', '/'),
+        ('blocks page 5', '/blocks?index=5'),
+        ('transactions', '/transactions'),
+        ('transactions page 50', '/transactions?index=50'),
+        ('block', '/block/' + b2lx(samples['block'])),
+        ('huge block', '/block/' + b2lx(samples['huge_block'])),
+        ('transaction', '/transaction/' + b2lx(samples['tx'])),
+        ('huge transaction', '/transaction/' + b2lx(samples['huge_tx'])),
+        ('address', '/address/' + address_str(samples['address'], version)),
+        ('whale address', '/address/' + address_str(samples['whale'], version)),
+        # History pages by position, so deep is as cheap as the first page
+        ('whale deep page', '/address/{}?before={}-{}-0'
+         .format(address_str(samples['whale'], version),
+                 samples['middle_height'], 'ff' * 32)),
+        ('search tx', '/search/' + b2lx(samples['tx'])),
+        ('search height', '/search/15'),
+        ('search miss', '/search/' + 'f' * 64),
+    ]
+
+
+def measure(urls, requests=20):
+    """ Drives each url through the test client, returning p50/p99 latency
+    and queries issued per request """
+    app = current_app._get_current_object()
+    client = app.test_client()
+
+    queries = [0]
+
+    def count_query(*args, **kwargs):
+        queries[0] += 1
+    sqlalchemy.event.listen(db.engine, 'before_cursor_execute', count_query)
+
+    def get(url):
+        # Reading data drains streamed responses too
+        client.get(url).data
+        # manage.py commands run inside an app context, so the test client
+        # doesn't push its own and the session would never be torn down
+        db.session.remove()
+
+    reports = []
+    try:
+        db.session.remove()
+        for name, url in urls:
+            # Warm up template compilation and caches
+            get(url)
+            latencies = []
+            start_queries = queries[0]
+            for _ in range(requests):
+                with Timer() as t:
+                    get(url)
+                latencies.append(t.elapsed)
+            reports.append(dict(name=name,
+                                p50_ms=percentile(latencies, 50) * 1000,
+                                p99_ms=percentile(latencies, 99) * 1000,
+                                queries=(queries[0] - start_queries) / float(requests)))
+    finally:
+        sqlalchemy.event.remove(db.engine, 'before_cursor_execute', count_query)
+    return reports
+
+
+def run(database, populate=True, requests=20, **options):
+    """ Points the app at `database`, optionally wipes and bulk loads it,
+    then measures every route. Only use a scratch database """
+    app = current_app._get_current_object()
+    app.config['SQLALCHEMY_DATABASE_URI'] = database
+    app.replica_router = None
+    # Keep the cache keys this writes away from any live explorer's
+    app.config['currency'] = dict(app.config['currency'], code='BENCH')
+    version = app.config['currency']['p2pkh_address_version']
+
+    if populate:
+        samples = Populator(**options).run()
+    else:
+        huge_tx = (db.session.query(Output.origin_tx_hash)
+                   .order_by(Output.index.desc()).limit(1).scalar())
+        samples = {
+            'block': Block.query.order_by(Block.height.desc()).first().hash,
+            'huge_block': Block.query.filter_by(height=10).one().hash,
+            'tx': Transaction.query.filter(Transaction.txid != huge_tx)
+                                   .order_by(Transaction.id.desc()).first().txid,
+            'huge_tx': huge_tx,
+            'whale': Address.query.filter_by(id=1).one().hash,
+            'address': Address.query.order_by(Address.id.desc()).first().hash,
+            'middle_height': Block.query.order_by(Block.height.desc()).first().height // 2,
+        }
+    cache.rebuild_block_ring()
+    return measure(routes(samples, version), requests)
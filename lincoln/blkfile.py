@@ -0,0 +1,110 @@
+import glob
+import hashlib
+import mmap
+import os
+import struct
+from binascii import unhexlify
+
+from bitcoin.core import CBlock
+from flask import current_app
+
+
+class BufferReader(object):
+    """ Minimal file-like reader over a memoryview. python-bitcoinlib pulls
+    blocks apart with many small reads, so this hands out slices of the
+    mapped file instead of first copying the whole block into a BytesIO """
+
+    def __init__(self, view):
+        self.view = view
+        self.pos = 0
+
+    def read(self, n):
+        start = self.pos
+        self.pos = min(start + n, len(self.view))
+        return self.view[start:self.pos].tobytes()
+
+
+class BlockIndex(object):
+    """ Index of the raw blocks the coin daemon keeps in its blk*.dat files.
+    Each file is a sequence of records made of the network magic, a 32 bit
+    little-endian length and the serialized block. Only headers are read
+    while indexing, blocks are deserialized when they're asked for """
+
+    def __init__(self, blocks_dir, magic):
+        self.blocks_dir = blocks_dir
+        self.magic = magic
+        self.maps = []
+        # block hash -> (map number, offset of block, length)
+        self.locations = {}
+        # previous block hash -> [child block hashes]
+        self.children = {}
+
+    def scan(self):
+        paths = sorted(glob.glob(os.path.join(self.blocks_dir, 'blk*.dat')))
+        for path in paths:
+            with open(path, 'rb') as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    continue
+                self.maps.append(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+            self._scan_map(len(self.maps) - 1, path)
+        current_app.logger.info("Indexed {:,} blocks from {:,} block files"
+                                .format(len(self.locations), len(self.maps)))
+        return self
+
+    def _scan_map(self, num, path):
+        buf = memoryview(self.maps[num])
+        pos = 0
+        while pos + 8 <= len(buf):
+            magic = buf[pos:pos + 4].tobytes()
+            if magic != self.magic:
+                # Files are preallocated, so zeros mark the end of the data
+                if magic != b'\x00' * 4:
+                    current_app.logger.warn(
+                        "Bad magic at offset {} of {}, skipping rest of file"
+                        .format(pos, path))
+                break
+            size, = struct.unpack_from('<I', buf, pos + 4)
+            start = pos + 8
+            if start + size > len(buf):
+                break
+            header = buf[start:start + 80]
+            block_hash = hashlib.sha256(hashlib.sha256(header).digest()).digest()
+            prev_hash = header[4:36].tobytes()
+            self.locations[block_hash] = (num, start, size)
+            self.children.setdefault(prev_hash, []).append(block_hash)
+            pos = start + size
+
+    def read(self, block_hash):
+        """ Deserializes a block straight out of the mapped file, or returns
+        None if it isn't in the files that were scanned """
+        location = self.locations.get(block_hash)
+        if location is None:
+            return None
+        num, start, size = location
+        view = memoryview(self.maps[num])[start:start + size]
+        return CBlock.stream_deserialize(BufferReader(view))
+
+    def next_block(self, prev_hash, best_hash):
+        """ Follows hashPrevBlock links from prev_hash and returns the child
+        that the coin daemon says is on the best chain """
+        if best_hash in self.children.get(prev_hash, ()):
+            return self.read(best_hash)
+        return None
+
+    def close(self):
+        for m in self.maps:
+            m.close()
+        self.maps = []
+
+
+def open_index(blocks_dir):
+    magic = unhexlify(current_app.config['currency']['network_magic'])
+    return BlockIndex(blocks_dir, magic).scan()
+
+
+def write_blocks(path, blocks, magic):
+    """ Writes blocks out in blk*.dat format, used by the sync benchmark """
+    with open(path, 'wb') as f:
+        for block in blocks:
+            raw = block.serialize()
+            f.write(magic + struct.pack('<I', len(raw)) + raw)
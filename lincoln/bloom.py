@@ -0,0 +1,228 @@
+""" Bloom filters in redis over every known block hash, txid and address
+hash, so lookups of things that don't exist can answer "not found" without
+touching the database. Sync adds to them as it goes. A filter only answers
+once it has been fully built by `manage.py bloom_rebuild`; until then, and
+whenever redis is unavailable, every lookup falls through to SQL.
+
+Each build fills a new generation of bits beside the filter in use, and
+lookups only switch to it once it's complete, so rebuilding a live filter
+never answers "not found" for something that exists. """
+import math
+import time
+
+from flask import current_app
+from redis.exceptions import RedisError
+
+from . import redis_conn, cache
+
+KINDS = ('block', 'tx', 'address')
+# Seconds a web worker trusts its copy of a filter's size and ready flag
+META_TTL = 10
+DEFAULT_CAPACITY = {'block': 2000000, 'tx': 20000000, 'address': 10000000}
+
+_meta_cache = {}
+
+
+def bits_key(kind, generation):
+    return cache.key('bloom:{}:bits:{}'.format(kind, generation))
+
+
+def meta_key(kind, building=False):
+    """ The filter lookups use, or the one being built to replace it """
+    return cache.key('bloom:{}:{}'.format(kind, 'build' if building else 'meta'))
+
+
+def generation_key(kind):
+    return cache.key('bloom:{}:generation'.format(kind))
+
+
+def enabled():
+    return bool(current_app.config.get('bloom_filters', False))
+
+
+def size_for(capacity, error_rate):
+    """ Optimal bit count and hash count for `capacity` items at the given
+    false positive rate """
+    bits = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+    hashes = max(1, int(round(bits / float(capacity) * math.log(2))))
+    return bits, hashes
+
+
+def positions(raw, bits, hashes):
+    """ Everything stored is already a cryptographic hash, so its own bytes
+    seed the double hashing instead of hashing it again """
+    h1 = int.from_bytes(raw[:8], 'little')
+    h2 = int.from_bytes(raw[8:16], 'little') | 1
+    return [(h1 + i * h2) % bits for i in range(hashes)]
+
+
+def _decode(raw):
+    return dict((k.decode('utf8') if isinstance(k, bytes) else k,
+                 v.decode('utf8') if isinstance(v, bytes) else v)
+                for k, v in raw.items())
+
+
+def read_meta(kind, building=False):
+    meta = _decode(redis_conn.hgetall(meta_key(kind, building)))
+    # A sync racing the end of a build can leave a stray counter behind
+    if 'bits' not in meta:
+        return None
+    for k in ('bits', 'hashes', 'added', 'ready', 'rebuilt_to', 'generation'):
+        meta[k] = int(meta.get(k, 0))
+    return meta
+
+
+def _cached_meta(kind):
+    now = time.time()
+    cached = _meta_cache.get(kind)
+    if cached is None or now - cached[0] > META_TTL:
+        cached = (now, read_meta(kind))
+        _meta_cache[kind] = cached
+    return cached[1]
+
+
+def definitely_missing(kind, raw):
+    """ True only if `raw` has certainly never been added. Any doubt, such as
+    an unbuilt filter or a redis error, answers False """
+    if not enabled() or not raw:
+        return False
+    try:
+        meta = _cached_meta(kind)
+        if not meta or not meta['ready']:
+            return False
+        key = bits_key(kind, meta['generation'])
+        pipe = redis_conn.pipeline(transaction=False)
+        for pos in positions(raw, meta['bits'], meta['hashes']):
+            pipe.getbit(key, pos)
+        return not all(pipe.execute())
+    except RedisError:
+        current_app.logger.warn("Unable to check bloom filter", exc_info=True)
+        return False
+
+
+def add(items):
+    """ Adds {kind: [raw hashes]} to the filters in use and to any being
+    built. Called by sync for each block, and skips filters that haven't
+    been created yet """
+    if not enabled():
+        return
+    try:
+        pipe = redis_conn.pipeline(transaction=False)
+        for kind, raws in items.items():
+            for building in (False, True):
+                meta = read_meta(kind, building)
+                if not meta or not raws:
+                    continue
+                key = bits_key(kind, meta['generation'])
+                for raw in raws:
+                    for pos in positions(raw, meta['bits'], meta['hashes']):
+                        pipe.setbit(key, pos, 1)
+                pipe.hincrby(meta_key(kind, building), 'added', len(raws))
+        pipe.execute()
+    except RedisError:
+        current_app.logger.warn("Unable to update bloom filters", exc_info=True)
+
+
+def _source(kind):
+    from .models import Block, Transaction, Address
+    return {'block': (Block, Block.hash),
+            'tx': (Transaction, Transaction.txid),
+            'address': (Address, Address.hash)}[kind]
+
+
+def rebuild(kind, resume=True, chunk_size=10000):
+    """ Fills a new generation of a filter from the database in id order,
+    checkpointing after each chunk so an interrupted rebuild picks up where
+    it stopped. Sync keeps adding to it meanwhile, and lookups keep using
+    the previous generation until it's done """
+    capacity = int(current_app.config.get('bloom_capacity', {}).get(
+        kind, DEFAULT_CAPACITY[kind]))
+    error_rate = float(current_app.config.get('bloom_error_rate', 0.001))
+    bits, hashes = size_for(capacity, error_rate)
+
+    build_key = meta_key(kind, building=True)
+    meta = read_meta(kind, building=True)
+    if not (resume and meta and meta['bits'] == bits and
+            meta['hashes'] == hashes):
+        generation = redis_conn.incr(generation_key(kind))
+        pipe = redis_conn.pipeline()
+        if meta:
+            pipe.delete(bits_key(kind, meta['generation']))
+        pipe.delete(build_key)
+        pipe.hmset(build_key, dict(bits=bits, hashes=hashes,
+                                   capacity=capacity, error_rate=error_rate,
+                                   generation=generation, added=0, ready=0,
+                                   rebuilt_to=0))
+        pipe.execute()
+        meta = read_meta(kind, building=True)
+
+    model, column = _source(kind)
+    key = bits_key(kind, meta['generation'])
+    last_id = meta['rebuilt_to']
+    while True:
+        rows = (model.query.with_entities(model.id, column)
+                .filter(model.id > last_id)
+                .order_by(model.id)
+                .limit(chunk_size).all())
+        if not rows:
+            break
+        pipe = redis_conn.pipeline(transaction=False)
+        for _, raw in rows:
+            for pos in positions(raw, bits, hashes):
+                pipe.setbit(key, pos, 1)
+        last_id = rows[-1][0]
+        pipe.hincrby(build_key, 'added', len(rows))
+        pipe.hset(build_key, 'rebuilt_to', last_id)
+        pipe.execute()
+        current_app.logger.info("{} bloom filter built up to id {:,}"
+                                .format(kind, last_id))
+
+    # Switch lookups over. Workers may hold the old meta for up to META_TTL,
+    # so the old bits stay a while longer for them
+    old = read_meta(kind)
+    pipe = redis_conn.pipeline()
+    pipe.rename(build_key, meta_key(kind))
+    pipe.hset(meta_key(kind), 'ready', 1)
+    if old:
+        pipe.expire(bits_key(kind, old['generation']), META_TTL * 3)
+    pipe.execute()
+    _meta_cache.pop(kind, None)
+
+
+def reset():
+    """ Drops every filter, for when the database is replaced wholesale and
+    they would otherwise rule out rows they've never seen. Lookups stop
+    using them at once, but as after a rebuild, the bits of filters in use
+    are left to expire for workers still holding their meta """
+    pipe = redis_conn.pipeline()
+    for kind in KINDS:
+        live = read_meta(kind)
+        if live:
+            pipe.expire(bits_key(kind, live['generation']), META_TTL * 3)
+        building = read_meta(kind, building=True)
+        if building:
+            pipe.delete(bits_key(kind, building['generation']))
+        pipe.delete(meta_key(kind), meta_key(kind, building=True))
+    pipe.execute()
+    _meta_cache.clear()
+
+
+def stats(kind):
+    """ Size and accuracy of a filter. The false positive rate is estimated
+    from the fraction of bits actually set, so it reflects what's been added
+    rather than what was planned for. A filter still being built for the
+    first time is shown as it stands """
+    meta = read_meta(kind) or read_meta(kind, building=True)
+    if not meta:
+        return None
+    key = bits_key(kind, meta['generation'])
+    set_bits = redis_conn.bitcount(key)
+    fill = set_bits / float(meta['bits'])
+    return dict(kind=kind,
+                ready=bool(meta['ready']),
+                added=meta['added'],
+                capacity=int(meta['capacity']),
+                hashes=meta['hashes'],
+                memory_mb=redis_conn.strlen(key) / 1024.0 / 1024.0,
+                fill=fill,
+                false_positive_rate=fill ** meta['hashes'])
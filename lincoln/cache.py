@@ -0,0 +1,210 @@
+import calendar
+import datetime
+import json
+import time
+from decimal import Decimal
+
+from flask import current_app
+from redis.exceptions import RedisError
+import sqlalchemy
+
+from lincoln.filters import currency
+from lincoln.utils import hash_str as encode_hash
+from . import db, redis_conn
+
+
+def key(name):
+    """ Namespaces a redis key by currency, since several explorers commonly
+    share one redis server """
+    return "lincoln:{}:{}".format(current_app.config['currency']['code'], name)
+
+
+class BlockSummary(object):
+    """ Stand in for a Block row built from the cached ring of recent blocks.
+    Exposes the attributes blocks_table.html needs, so the front page can be
+    rendered without touching the database """
+
+    def __init__(self, height, hash, time, difficulty, total_out, tx_count):
+        self.height = height
+        self.hash_str = hash
+        self.timestamp = time
+        self.ntime = datetime.datetime.utcfromtimestamp(time)
+        self.difficulty = difficulty
+        self.total_out = Decimal(total_out)
+        self.tx_count = tx_count
+
+    @property
+    def url_for(self):
+        return "/block/{}".format(self.hash_str)
+
+    @classmethod
+    def from_block(cls, block, tx_count):
+        return cls(height=block.height,
+                   hash=encode_hash(block.hash),
+                   time=calendar.timegm(block.ntime.utctimetuple()),
+                   difficulty=block.difficulty,
+                   total_out=str(block.total_out),
+                   tx_count=tx_count)
+
+    def serialize(self):
+        return json.dumps(dict(height=self.height,
+                               hash=self.hash_str,
+                               time=self.timestamp,
+                               difficulty=self.difficulty,
+                               total_out=str(self.total_out),
+                               tx_count=self.tx_count))
+
+    @classmethod
+    def deserialize(cls, raw):
+        if isinstance(raw, bytes):
+            raw = raw.decode('utf8')
+        return cls(**json.loads(raw))
+
+
+def ring_size():
+    return int(current_app.config.get('block_ring_size', 100))
+
+
+def rebuild_block_ring():
+    """ Repopulates the recent block ring from the database. Used when the
+    ring is missing or no longer lines up with the chain, e.g. after a fork
+    rollback """
+    from .models import Block, Transaction
+
+    size = ring_size()
+    blocks = Block.query.order_by(Block.height.desc()).limit(size).all()
+    counts = {}
+    if blocks:
+        counts = dict(db.session.query(Transaction.block_id,
+                                       sqlalchemy.func.count(Transaction.id))
+                      .filter(Transaction.block_id.in_([b.id for b in blocks]))
+                      .group_by(Transaction.block_id))
+
+    try:
+        pipe = redis_conn.pipeline()
+        pipe.delete(key('recent_blocks'))
+        if blocks:
+            pipe.rpush(key('recent_blocks'),
+                       *[BlockSummary.from_block(b, counts.get(b.id, 0)).serialize()
+                         for b in blocks])
+        pipe.execute()
+    except RedisError:
+        current_app.logger.warn("Unable to rebuild recent block cache",
+                                exc_info=True)
+
+
+def push_block(block, tx_count):
+    """ Called by sync after each block commits. Prepends the block to the
+    ring, or rebuilds the ring if it doesn't end right below this block """
+    size = ring_size()
+    if not size:
+        return
+
+    ring = key('recent_blocks')
+    try:
+        head = redis_conn.lindex(ring, 0)
+        if head is None or BlockSummary.deserialize(head).height != block.height - 1:
+            rebuild_block_ring()
+            return
+
+        pipe = redis_conn.pipeline()
+        pipe.lpush(ring, BlockSummary.from_block(block, tx_count).serialize())
+        pipe.ltrim(ring, 0, size - 1)
+        pipe.execute()
+    except RedisError:
+        current_app.logger.warn("Unable to update recent block cache",
+                                exc_info=True)
+
+
+def recent_blocks(offset, limit):
+    """ Returns BlockSummary objects for a page of the most recent blocks, or
+    None if the ring doesn't cover the requested page """
+    if offset + limit > ring_size():
+        return None
+
+    try:
+        raw = redis_conn.lrange(key('recent_blocks'), offset, offset + limit - 1)
+    except RedisError:
+        current_app.logger.warn("Unable to read recent block cache",
+                                exc_info=True)
+        return None
+
+    blocks = [BlockSummary.deserialize(r) for r in raw]
+    # A short page is only complete if it runs all the way down to genesis
+    if len(blocks) < limit and (not blocks or blocks[-1].height != 0):
+        return None
+    return blocks
+
+
+def feed_tx(tx):
+    """ Compact, display ready summary of a transaction for the live feed """
+    return dict(hash=encode_hash(tx.txid),
+                url=tx.url_for,
+                height=tx.height,
+                block_url=tx.block_url_for,
+                total_out=currency(tx.total_out),
+                fee=None if tx.coinbase else currency(tx.total_in - tx.total_out))
+
+
+def feed_max_txs():
+    return int(current_app.config.get('feed_max_txs', 25))
+
+
+def publish_block(block, tx_count, txs):
+    """ Announces a newly synced block, and the feed summaries of its last
+    transactions, to web workers serving the live feed """
+    summary = BlockSummary.from_block(block, tx_count)
+    message = dict(block=dict(height=summary.height,
+                              hash=summary.hash_str,
+                              url=summary.url_for,
+                              time=summary.timestamp,
+                              difficulty='{:,}'.format(round(summary.difficulty, 4)),
+                              total_out=currency(summary.total_out),
+                              tx_count=tx_count),
+                   txs=list(txs))
+    try:
+        redis_conn.publish(key('feed'), json.dumps(message))
+    except RedisError:
+        current_app.logger.warn("Unable to publish block to the live feed",
+                                exc_info=True)
+
+
+def publish_sync_status(height, server_height, blocks_per_sec):
+    """ Records sync progress so the web side can report how far behind it
+    is without asking the coin daemon """
+    if blocks_per_sec:
+        eta = (server_height - height) / blocks_per_sec
+    else:
+        eta = 0
+    try:
+        redis_conn.hmset(key('sync_status'),
+                         dict(height=height,
+                              server_height=server_height,
+                              blocks_per_sec=blocks_per_sec,
+                              eta=eta,
+                              updated_at=time.time()))
+    except RedisError:
+        current_app.logger.warn("Unable to publish sync status",
+                                exc_info=True)
+
+
+def sync_status():
+    """ Returns the last progress sync reported, or None if it never has """
+    try:
+        raw = redis_conn.hgetall(key('sync_status'))
+    except RedisError:
+        current_app.logger.warn("Unable to read sync status", exc_info=True)
+        return None
+    if not raw:
+        return None
+
+    status = {}
+    for k, v in raw.items():
+        if isinstance(k, bytes):
+            k = k.decode('utf8')
+        status[k] = float(v)
+    for k in ('height', 'server_height'):
+        status[k] = int(status[k])
+    status['lag'] = max(status['server_height'] - status['height'], 0)
+    status['age'] = max(time.time() - status['updated_at'], 0)
+    return status
@@ -0,0 +1,182 @@
+""" Time series of difficulty, estimated network hashrate, transaction count
+and volume. Sync adds each block to chart_rollup once per resolution, and
+rollbacks take it back out, so a chart over any range is a single indexed
+read of at most `chart_max_points` rows at the finest resolution that fits. """
+import calendar
+import datetime
+
+import sqlalchemy
+from flask import current_app
+
+from . import db
+from .models import Block, Transaction, ChartRollup
+
+# Finest first. Per block rows are keyed by height, the others by period
+RESOLUTIONS = (('block', None), ('hour', 3600), ('day', 86400),
+               ('week', 7 * 86400))
+METRICS = ('difficulty', 'hashrate', 'transactions', 'volume')
+
+
+def unix_time(dt):
+    return calendar.timegm(dt.utctimetuple())
+
+
+def periods(block):
+    """ (resolution, period, start) of every rollup row a block counts in """
+    ts = unix_time(block.ntime)
+    rows = []
+    for resolution, length in RESOLUTIONS:
+        if length is None:
+            rows.append((resolution, block.height, block.ntime))
+        else:
+            period = ts // length
+            rows.append((resolution, period,
+                         datetime.datetime.utcfromtimestamp(period * length)))
+    return rows
+
+
+def _apply(block, tx_count, sign):
+    volume = int(block.total_out * 100000000)
+    changes = {
+        ChartRollup.blocks: ChartRollup.blocks + sign,
+        ChartRollup.difficulty: ChartRollup.difficulty + sign * block.difficulty,
+        ChartRollup.transactions: ChartRollup.transactions + sign * tx_count,
+        ChartRollup.volume: ChartRollup.volume + sign * volume}
+    for resolution, period, start in periods(block):
+        rows = ChartRollup.query.filter_by(resolution=resolution, period=period)
+        updated = rows.update(changes, synchronize_session=False)
+        if not updated and sign > 0:
+            db.session.add(ChartRollup(resolution=resolution, period=period,
+                                       start=start, blocks=1,
+                                       difficulty=block.difficulty,
+                                       transactions=tx_count, volume=volume))
+        if sign < 0:
+            # Periods left without blocks go
+            rows.filter(ChartRollup.blocks <= 0).delete(
+                synchronize_session=False)
+    db.session.flush()
+
+
+def add_block(block, tx_count):
+    _apply(block, tx_count, 1)
+
+
+def remove_block(block, tx_count):
+    _apply(block, tx_count, -1)
+
+
+def hashrate(difficulty):
+    """ Network hashes per second needed to find blocks of this difficulty
+    at the target block time """
+    return (difficulty * current_app.config['algo']['hashes_per_share'] /
+            current_app.config['currency']['block_time'])
+
+
+def value(row, metric):
+    if metric == 'difficulty':
+        return row.difficulty / row.blocks
+    if metric == 'hashrate':
+        return hashrate(row.difficulty / row.blocks)
+    if metric == 'transactions':
+        return row.transactions
+    return row.volume / 100000000.0
+
+
+def _rows(resolution, start, end, limit):
+    return (ChartRollup.query
+            .filter(ChartRollup.resolution == resolution,
+                    ChartRollup.start >= start,
+                    ChartRollup.start <= end)
+            .order_by(ChartRollup.start)
+            .limit(limit).all())
+
+
+def _merge(rows, size):
+    """ Sums consecutive rows in groups of `size`, for ranges too long even
+    for weekly points """
+    merged = []
+    for i in range(0, len(rows), size):
+        group = rows[i:i + size]
+        merged.append(ChartRollup(start=group[0].start,
+                                  blocks=sum(r.blocks for r in group),
+                                  difficulty=sum(r.difficulty for r in group),
+                                  transactions=sum(r.transactions for r in group),
+                                  volume=sum(r.volume for r in group)))
+    return merged
+
+
+def series(metric, start, end, max_points=None):
+    """ Returns (resolution, [(unix time, value)]) for `metric` between two
+    datetimes, at the finest resolution that needs no more than `max_points`
+    points """
+    if max_points is None:
+        max_points = int(current_app.config.get('chart_max_points', 500))
+    block_time = current_app.config['currency']['block_time']
+    # Measure the span over the blocks actually in the range, so an open
+    # ended range isn't charted coarser than the chain needs
+    first, last = (db.session.query(sqlalchemy.func.min(ChartRollup.start),
+                                    sqlalchemy.func.max(ChartRollup.start))
+                   .filter_by(resolution='block').one())
+    if first is None:
+        return RESOLUTIONS[0][0], []
+    span = max(unix_time(min(end, last)) - unix_time(max(start, first)), 1)
+
+    rows = None
+    for resolution, length in RESOLUTIONS:
+        # Skip resolutions that can't fit without reading them. Blocks come
+        # irregularly, so a fitting estimate still gets checked
+        if span / (length or block_time) > max_points * 2:
+            continue
+        rows = _rows(resolution, start, end, max_points + 1)
+        if len(rows) <= max_points:
+            break
+    else:
+        # Even weekly points overflow, so combine them. The weeks in a range
+        # are few enough to read whole
+        rows = _rows(resolution, start, end, None)
+        rows = _merge(rows, -(-len(rows) // max_points))
+
+    return resolution, [(unix_time(row.start), value(row, metric))
+                        for row in rows if row.blocks]
+
+
+def rebuild(chunk_size=10000):
+    """ Recomputes every rollup from the blocks. Sync keeps them current;
+    this is for filling them in on an existing database """
+    ChartRollup.query.delete(synchronize_session=False)
+    coarse = {}
+    last_height = -1
+    while True:
+        blocks = (Block.query.filter(Block.height > last_height)
+                  .order_by(Block.height).limit(chunk_size).all())
+        if not blocks:
+            break
+        last_height = blocks[-1].height
+        tx_counts = dict(
+            db.session.query(Transaction.block_id, sqlalchemy.func.count())
+            .filter(Transaction.height.between(blocks[0].height, last_height))
+            .group_by(Transaction.block_id))
+        for block in blocks:
+            tx_count = tx_counts.get(block.id, 0)
+            volume = int(block.total_out * 100000000)
+            for resolution, period, start in periods(block):
+                if resolution == 'block':
+                    db.session.add(ChartRollup(
+                        resolution=resolution, period=period, start=start,
+                        blocks=1, difficulty=block.difficulty,
+                        transactions=tx_count, volume=volume))
+                    continue
+                row = coarse.get((resolution, period))
+                if row is None:
+                    row = coarse[(resolution, period)] = ChartRollup(
+                        resolution=resolution, period=period, start=start,
+                        blocks=0, difficulty=0, transactions=0, volume=0)
+                row.blocks += 1
+                row.difficulty += block.difficulty
+                row.transactions += tx_count
+                row.volume += volume
+        db.session.flush()
+        db.session.expunge_all()
+        current_app.logger.info("Charted blocks up to {:,}".format(last_height))
+    db.session.add_all(coarse.values())
+    db.session.commit()
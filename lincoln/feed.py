@@ -0,0 +1,99 @@
+""" Live feed of new blocks and transactions. Sync publishes one message per
+block to a redis channel; each web worker keeps a single subscription and
+fans messages out to its connected Server-Sent Events clients, so idle
+subscribers cost neither database queries nor redis connections.
+
+Every client holds a request open, so /stream needs a cooperative worker
+such as gunicorn's gevent worker, which also turns the threads and queues
+used here into greenlets. """
+import queue
+import threading
+import time
+
+from flask import current_app
+from redis.exceptions import RedisError
+
+from . import cache
+
+
+class Broadcaster(object):
+    def __init__(self, app, channel):
+        self.app = app
+        self.channel = channel
+        self.clients = set()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def subscribe(self, backlog):
+        client = queue.Queue(maxsize=backlog)
+        with self.lock:
+            self.clients.add(client)
+            # Started lazily, so that it runs in the forked worker
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run,
+                                               name='lincoln-feed')
+                self.thread.daemon = True
+                self.thread.start()
+        return client
+
+    def unsubscribe(self, client):
+        with self.lock:
+            self.clients.discard(client)
+
+    def broadcast(self, data):
+        with self.lock:
+            clients = list(self.clients)
+        for client in clients:
+            try:
+                client.put_nowait(data)
+            except queue.Full:
+                # A client this far behind is gone or hopeless, cut it loose
+                # rather than buffer for it
+                self.unsubscribe(client)
+
+    def run(self):
+        while True:
+            try:
+                pubsub = self.app.redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                for message in pubsub.listen():
+                    if message['type'] != 'message':
+                        continue
+                    data = message['data']
+                    if isinstance(data, bytes):
+                        data = data.decode('utf8')
+                    self.broadcast(data)
+            except RedisError:
+                self.app.logger.warn("Live feed lost its redis subscription, "
+                                     "retrying", exc_info=True)
+                time.sleep(5)
+
+
+def broadcaster():
+    app = current_app._get_current_object()
+    if getattr(app, 'feed_broadcaster', None) is None:
+        app.feed_broadcaster = Broadcaster(app, cache.key('feed'))
+    return app.feed_broadcaster
+
+
+def event_stream():
+    """ Generator of SSE frames for one client. Comments are sent while idle
+    so proxies don't time out the connection and dead clients get noticed """
+    keepalive = int(current_app.config.get('feed_keepalive', 15))
+    backlog = int(current_app.config.get('feed_client_backlog', 50))
+    source = broadcaster()
+    client = source.subscribe(backlog)
+
+    def frames():
+        try:
+            yield "retry: 5000\n\n"
+            while client in source.clients:
+                try:
+                    data = client.get(timeout=keepalive)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                else:
+                    yield "event: block\ndata: {}\n\n".format(data)
+        finally:
+            source.unsubscribe(client)
+    return frames()
@@ -1,10 +1,11 @@
 from math import log10, floor
 from decimal import Decimal
 
-import bitcoin.core as core
 import datetime
 import ago
 
+from lincoln import utils
+
 
 def sig_round(x, sig=2):
     try:
@@ -70,4 +71,4 @@ def currency(value):
 
 
 def bytes(val):
-    return core.b2lx(val)
+    return utils.hash_str(val)
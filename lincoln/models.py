@@ -1,13 +1,17 @@
 import calendar
 import binascii
+from decimal import Decimal
 import bitcoin.core as core
 import bitcoin.base58 as base58
 from flask import current_app
 import sqlalchemy
-from lincoln.utils import get_int_from_str
+from lincoln.utils import (get_int_from_str, hash_str as encode_hash,
+                           address_str as encode_address)
 
 from .model_lib import base
-from . import db
+from . import db, bloom
+# Registers the postgres DDL hooks for partitioned tables
+from . import partitioning  # noqa
 
 
 class Block(base):
@@ -41,7 +45,7 @@ class Block(base):
 
     @property
     def hash_str(self):
-        return core.b2lx(self.hash)
+        return encode_hash(self.hash)
 
     @property
     def url_for(self):
@@ -84,12 +88,12 @@ class Block(base):
 
         # Not a blockheight, try to match it to a block hash
         bhash = cls.format_query_str(query_str)
-        if not bhash:
+        if not bhash or bloom.definitely_missing('block', bhash):
             return []
 
         limit = current_app.config.get('search_result_limit', 10)
         try:
-            blocks = cls.query.filter(cls.hash.like(bhash)).limit(limit).all()
+            blocks = cls.query.filter(cls.hash == bhash).limit(limit).all()
         except sqlalchemy.exc.SQLAlchemyError:
             return []
         else:
@@ -105,13 +109,32 @@ class Transaction(base):
     block_id = db.Column(db.Integer, db.ForeignKey('block.id'))
     block = db.relationship('Block', foreign_keys=[block_id],
                             backref='transactions')
+    # Height and time of the containing block, so listings needn't join it.
+    # Postgres partitions on height
+    height = db.Column(db.Integer, nullable=False)
+    ntime = db.Column(db.DateTime, nullable=False)
     # Cache of all outputs in and out
     total_in = db.Column(db.Numeric)
     total_out = db.Column(db.Numeric)
 
+    __table_args__ = (
+        db.Index('transaction_ntime', 'ntime'),
+        # Pruning and the audit select transactions by block height
+        db.Index('transaction_height', 'height'),
+        {'info': {'partition_by': 'height'}},
+    )
+
+    @property
+    def timestamp(self):
+        return calendar.timegm(self.ntime.utctimetuple())
+
     @property
     def hash_str(self):
-        return core.b2lx(self.txid)
+        return encode_hash(self.txid)
+
+    @property
+    def block_url_for(self):
+        return "/block/height/{}".format(self.height)
 
     @property
     def url_for(self):
@@ -139,12 +162,12 @@ class Transaction(base):
         Takes an address pkh, queries for addresses
         """
         hash = cls.format_query_str(query_str)
-        if not hash:
+        if not hash or bloom.definitely_missing('tx', hash):
             return []
 
         limit = current_app.config.get('search_result_limit', 10)
         try:
-            txs = cls.query.filter(cls.txid.like(hash)).limit(limit).all()
+            txs = cls.query.filter(cls.txid == hash).limit(limit).all()
         except sqlalchemy.exc.SQLAlchemyError:
             return []
         else:
@@ -164,6 +187,10 @@ class Address(base):
     total_in = db.Column(db.Numeric, default=0)
     total_out = db.Column(db.Numeric, default=0)
     first_seen_at = db.Column(db.DateTime)
+    # total_in - total_out in satoshis, kept by sync for the rich list. An
+    # integer so it sorts numerically on SQLite too
+    balance_satoshis = db.Column('balance', db.BigInteger, nullable=False,
+                                 default=0)
 
     __table_args__ = (
         db.Index('address_version', 'version'),
@@ -171,9 +198,7 @@ class Address(base):
 
     @property
     def hash_str(self):
-        return str(base58.CBase58Data.from_bytes(
-            self.hash,
-            nVersion=self.version))
+        return encode_address(self.hash, self.version)
 
     @property
     def url_for(self):
@@ -181,7 +206,7 @@ class Address(base):
 
     @property
     def balance(self):
-        return self.total_in - self.total_out
+        return Decimal(self.balance_satoshis) / 100000000
 
     def __str__(self):
         return "<Address h:{}>".format(self.hash_str)
@@ -220,18 +245,23 @@ class Address(base):
         Takes an address pkh, queries for addresses
         """
         pkhash = cls.format_query_str(query_str)
-        if not pkhash:
+        if not pkhash or bloom.definitely_missing('address', pkhash):
             return []
 
         limit = current_app.config.get('search_result_limit', 10)
         try:
-            addresses = cls.query.filter(cls.hash.like(b"%" + pkhash + b"%")).limit(limit).all()
+            # Exact match, so the unique index answers it rather than a scan
+            addresses = cls.query.filter(cls.hash == pkhash).limit(limit).all()
         except sqlalchemy.exc.SQLAlchemyError:
             return []
         else:
             return addresses
 
 
+# Rich list order. Declared once the table exists, since it's on an expression
+db.Index('address_balance', Address.__table__.c.balance.desc())
+
+
 class Output(base):
     type_map_str = {0: "p2sh", 1: "p2pkh", 2: "p2pk", 3: "non-std"}
     type_map_color = {0: "warning", 1: "danger", 2: "info", 3: "default"}
@@ -246,14 +276,16 @@ class Output(base):
     origin_tx = db.relationship('Transaction', foreign_keys=[origin_tx_hash],
                                 backref='origin_txs')
 
+    # Height of the block holding the origin tx. Postgres partitions on this
+    height = db.Column(db.Integer, nullable=False)
+
     # The amount it's worth
     amount = db.Column(db.Numeric)
     # It's index in the previous tx. Used to query when trying to spend it
     index = db.Column(db.SmallInteger, primary_key=True)
 
     # Address that gets to spend this output. Will be null for unusual tx types
-    address_hash = db.Column(db.LargeBinary, db.ForeignKey('address.hash'),
-                             index=True)
+    address_hash = db.Column(db.LargeBinary, db.ForeignKey('address.hash'))
     address = db.relationship('Address', foreign_keys=[address_hash],
                               backref='outputs')
 
@@ -263,6 +295,14 @@ class Output(base):
     spent_tx = db.relationship('Transaction', foreign_keys=[spend_tx_id],
                                backref='spent_txs')
 
+    __table_args__ = (
+        # Address history, newest first, straight off the index. It covers
+        # the whole sort order so a page never needs a sort
+        db.Index('output_address_height', 'address_hash', 'height',
+                 'origin_tx_hash', 'index'),
+        {'info': {'partition_by': 'height'}},
+    )
+
     @property
     def type_icon(self):
         return self.type_map_icon[self.type]
@@ -281,7 +321,10 @@ class Output(base):
 
     @property
     def address_str(self):
-        return self.address.hash_str
+        # Derive the version from the script type the same way sync does, so
+        # rendering an output never has to lazy load its Address
+        version = current_app.config['currency'][self.type_str + '_address_version']
+        return encode_address(self.address_hash, version)
 
     @property
     def url_for(self):
@@ -289,4 +332,60 @@ class Output(base):
 
     @property
     def timestamp(self):
-        return calendar.timegm(self.created_at.utctimetuple())
\ No newline at end of file
+        return self.origin_tx.timestamp
+
+
+class OutputArchive(base):
+    """ Outputs removed by pruning, packed and compressed per transaction. See
+    lincoln.pruning """
+    # The Transaction these outputs belong to
+    tx_id = db.Column(db.Integer, primary_key=True)
+    # Height of that transaction's block
+    height = db.Column(db.Integer, nullable=False)
+    # Outputs it created, and the outputs it spent
+    created = db.Column(db.LargeBinary)
+    spent = db.Column(db.LargeBinary)
+
+    __table_args__ = (
+        db.Index('output_archive_height', 'height'),
+    )
+
+
+class OutputArchiveAddress(base):
+    """ The archived transactions that paid each address, so its history
+    can page through pruned outputs newest first like live ones """
+    address_hash = db.Column(db.LargeBinary, primary_key=True)
+    height = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    # The paying transaction, by hash for ordering and by id for its archive
+    txid = db.Column(db.LargeBinary(64), primary_key=True)
+    tx_id = db.Column(db.Integer, nullable=False)
+
+
+class BalanceBucket(base):
+    """ How many addresses hold a balance of a given number of digits in
+    satoshis, and their combined balance. Sync keeps it current so the
+    distribution never has to scan every address. See lincoln.richlist """
+    # 0 for empty addresses, otherwise 10 ** (bucket - 1) <= balance < 10 ** bucket
+    bucket = db.Column(db.SmallInteger, primary_key=True, autoincrement=False)
+    addresses = db.Column(db.Integer, nullable=False, default=0)
+    total = db.Column(db.BigInteger, nullable=False, default=0)
+
+
+class ChartRollup(base):
+    """ Block totals summed per block, hour, day and week, so charts over
+    any range read a bounded number of rows. See lincoln.charts """
+    resolution = db.Column(db.String(8), primary_key=True)
+    # Block height for per block rows, otherwise the unix time the period
+    # starts at divided by its length
+    period = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    start = db.Column(db.DateTime, nullable=False)
+    blocks = db.Column(db.Integer, nullable=False, default=0)
+    # Sum over the blocks, averaged when charted
+    difficulty = db.Column(db.Float, nullable=False, default=0)
+    transactions = db.Column(db.Integer, nullable=False, default=0)
+    # Total output value in satoshis
+    volume = db.Column(db.BigInteger, nullable=False, default=0)
+
+    __table_args__ = (
+        db.Index('chart_rollup_start', 'resolution', 'start'),
+    )
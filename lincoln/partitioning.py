@@ -0,0 +1,142 @@
+""" Range partitioning of the transaction and output tables by block height on
+PostgreSQL 11 or later. Enabled by setting `partition_blocks` to the number of
+blocks each partition holds. Tables flag the column they're partitioned on
+with info={'partition_by': ...}; other databases ignore it entirely. """
+import sqlalchemy
+from flask import current_app
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.schema import CreateTable
+
+# Highest height the existing partitions cover, so sync only checks the
+# catalog when it crosses into a new range
+_covered = {}
+
+
+def partition_blocks():
+    return int(current_app.config.get('partition_blocks', 0) or 0)
+
+
+def enabled(bind):
+    return bind.dialect.name == 'postgresql' and partition_blocks() > 0
+
+
+def partitioned_tables(metadata):
+    return [t for t in metadata.sorted_tables if 'partition_by' in t.info]
+
+
+def _partitioned_copy(table):
+    """ Copy of a table fit for a partitioned parent: postgres requires the
+    partition key in every unique constraint, and nothing can reference a
+    partitioned table by foreign key. Foreign keys out to regular tables are
+    added back once the table exists """
+    key = table.info['partition_by']
+    metadata = sqlalchemy.MetaData()
+    columns = [sqlalchemy.Column(c.name, c.type,
+                                 primary_key=c.primary_key or c.name == key,
+                                 nullable=c.nullable,
+                                 # Keep the key out of the serial column
+                                 autoincrement=c is table._autoincrement_column,
+                                 server_default=c.server_default)
+               for c in table.c]
+    copy = sqlalchemy.Table(table.name, metadata, *columns)
+    for constraint in table.constraints:
+        if isinstance(constraint, sqlalchemy.UniqueConstraint):
+            names = [c.name for c in constraint.columns]
+            copy.append_constraint(sqlalchemy.UniqueConstraint(*(names + [key])))
+    return copy
+
+
+@compiles(CreateTable, 'postgresql')
+def create_table(create, compiler, **kw):
+    table = create.element
+    key = table.info.get('partition_by')
+    if key is None or partition_blocks() <= 0:
+        return compiler.visit_create_table(create)
+
+    text = compiler.visit_create_table(CreateTable(_partitioned_copy(table)))
+    return "{}PARTITION BY RANGE ({})\n\n".format(
+        text, compiler.preparer.quote(key))
+
+
+def _add_foreign_keys(table, bind):
+    preparer = bind.dialect.identifier_preparer
+    for fk in table.foreign_keys:
+        if 'partition_by' in fk.column.table.info:
+            continue
+        bind.execute('ALTER TABLE {} ADD FOREIGN KEY ({}) REFERENCES {} ({})'
+                     .format(preparer.format_table(table),
+                             preparer.quote(fk.parent.name),
+                             preparer.format_table(fk.column.table),
+                             preparer.quote(fk.column.name)))
+
+
+def create_partitions(bind, table, height):
+    """ Creates the partitions of `table` needed to hold rows up to `height`
+    plus one spare range, so sync never waits on DDL at a range boundary """
+    size = partition_blocks()
+    preparer = bind.dialect.identifier_preparer
+    for start in range(0, (height // size + 2) * size, size):
+        bind.execute('CREATE TABLE IF NOT EXISTS {} PARTITION OF {} '
+                     'FOR VALUES FROM ({}) TO ({})'.format(
+                         preparer.quote("{}_p{:08d}".format(table.name, start)),
+                         preparer.format_table(table), start, start + size))
+
+
+@sqlalchemy.event.listens_for(sqlalchemy.Table, 'after_create')
+def _after_create(table, bind, **kw):
+    if 'partition_by' not in table.info or not enabled(bind):
+        return
+    _add_foreign_keys(table, bind)
+    create_partitions(bind, table, 0)
+    _covered.clear()
+
+
+def ensure_partitions(engine, metadata, height):
+    """ Makes sure rows at `height` have a partition to go into. Runs on its
+    own connection so the partitions outlive a rolled back sync """
+    if not enabled(engine):
+        return
+    url = str(engine.url)
+    if _covered.get(url, -1) >= height:
+        return
+
+    size = partition_blocks()
+    with engine.begin() as conn:
+        for table in partitioned_tables(metadata):
+            create_partitions(conn, table, height)
+    _covered[url] = (height // size + 2) * size - 1
+
+
+def convert_tables(bind, metadata):
+    """ Rebuilds existing unpartitioned tables as partitioned ones, copying
+    their rows across. Used by the migration that introduces partitioning """
+    preparer = bind.dialect.identifier_preparer
+    tables = partitioned_tables(metadata)
+    for table in tables:
+        old = table.name + '_unpartitioned'
+        bind.execute('ALTER TABLE {} RENAME TO {}'.format(
+            preparer.format_table(table), preparer.quote(old)))
+        # Index and constraint names are schema wide, move them out of the way
+        for name, in bind.execute(sqlalchemy.text(
+                "SELECT indexname FROM pg_indexes WHERE tablename = :old"), old=old):
+            bind.execute('ALTER INDEX {} RENAME TO {}'.format(
+                preparer.quote(name), preparer.quote(name + '_unpartitioned')))
+
+    max_height = bind.execute('SELECT coalesce(max(height), 0) FROM block').scalar()
+    for table in tables:
+        table.create(bind)
+        create_partitions(bind, table, max_height)
+        columns = ', '.join(preparer.quote(c.name) for c in table.c)
+        bind.execute('INSERT INTO {} ({}) SELECT {} FROM {}'.format(
+            preparer.format_table(table), columns, columns,
+            preparer.quote(table.name + '_unpartitioned')))
+
+    for table in reversed(tables):
+        bind.execute('DROP TABLE {} CASCADE'.format(
+            preparer.quote(table.name + '_unpartitioned')))
+        if 'id' in table.c:
+            bind.execute(sqlalchemy.text(
+                "SELECT setval(pg_get_serial_sequence(:table, 'id'), "
+                "coalesce(max(id), 0) + 1, false) FROM {}".format(
+                    preparer.format_table(table))),
+                table=preparer.format_table(table))
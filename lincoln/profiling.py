@@ -0,0 +1,206 @@
+""" Opt in per-request profiling of the main blueprint. Counts queries, SQL
+time, the slowest statement and template render time for each request, and
+reports them in a Server-Timing header, a sampled slow request log and per
+route latency histograms in redis. """
+import random
+import time
+from contextlib import contextmanager
+
+import jinja2
+import sqlalchemy
+from flask import current_app, g, request, has_request_context
+from redis.exceptions import RedisError
+from sqlalchemy.engine import Engine
+
+from . import cache, redis_conn
+
+# Upper bounds of the latency histogram buckets, in milliseconds
+BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class RequestProfile(object):
+    def __init__(self):
+        self.start = time.time()
+        self.queries = 0
+        self.sql_time = 0.0
+        self.render_time = 0.0
+        self.slowest_time = 0.0
+        self.slowest_statement = None
+
+    def add_query(self, statement, elapsed):
+        self.queries += 1
+        self.sql_time += elapsed
+        if elapsed > self.slowest_time:
+            self.slowest_time = elapsed
+            self.slowest_statement = statement
+
+    @property
+    def elapsed(self):
+        return time.time() - self.start
+
+    def server_timing(self):
+        return ('sql;dur={:.1f};desc="{} queries", render;dur={:.1f}, '
+                'app;dur={:.1f}'.format(self.sql_time * 1000, self.queries,
+                                        self.render_time * 1000,
+                                        self.elapsed * 1000))
+
+
+def current_profile():
+    if not has_request_context():
+        return None
+    return getattr(g, 'profile', None)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if current_profile() is not None:
+        conn.info.setdefault('profile_query_start', []).append(time.time())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    profile = current_profile()
+    starts = conn.info.get('profile_query_start')
+    if profile is not None and starts:
+        profile.add_query(statement, time.time() - starts.pop())
+
+
+@contextmanager
+def rendering():
+    """ Charges the time spent in the block to template rendering, less any
+    queries the template triggered, which are already counted as SQL """
+    profile = current_profile()
+    if profile is None:
+        yield
+        return
+    start = time.time()
+    sql_time = profile.sql_time
+    try:
+        yield
+    finally:
+        profile.render_time += (time.time() - start) - (profile.sql_time - sql_time)
+
+
+class ProfiledTemplate(jinja2.Template):
+    """ Times rendering, including templates streamed out chunk by chunk """
+
+    def render(self, *args, **kwargs):
+        with rendering():
+            return jinja2.Template.render(self, *args, **kwargs)
+
+    def generate(self, *args, **kwargs):
+        chunks = jinja2.Template.generate(self, *args, **kwargs)
+        while True:
+            with rendering():
+                try:
+                    chunk = next(chunks)
+                except StopIteration:
+                    return
+            yield chunk
+
+
+def _profiled():
+    return request.blueprint == 'main'
+
+
+def start_request():
+    if _profiled():
+        g.profile = RequestProfile()
+
+
+def add_header(response):
+    """ Streamed pages render after this runs, so their header only covers
+    the work done before the body started """
+    profile = current_profile()
+    if profile is not None:
+        response.headers['Server-Timing'] = profile.server_timing()
+    return response
+
+
+def bucket_for(ms):
+    for bound in BUCKETS:
+        if ms <= bound:
+            return str(bound)
+    return 'inf'
+
+
+def finish_request(exc=None):
+    """ Runs once the response has been sent, streamed bodies included """
+    profile = current_profile()
+    if profile is None:
+        return
+    g.profile = None
+    elapsed_ms = profile.elapsed * 1000
+    route = request.url_rule.rule if request.url_rule else request.endpoint
+
+    slow_ms = float(current_app.config.get('profile_slow_ms', 1000))
+    sample_rate = float(current_app.config.get('profile_log_sample_rate', 1.0))
+    if elapsed_ms >= slow_ms and random.random() < sample_rate:
+        current_app.logger.warn(
+            "Slow request {} {:,.1f}ms: {} queries in {:,.1f}ms, render "
+            "{:,.1f}ms, slowest query {:,.1f}ms: {}".format(
+                request.path, elapsed_ms, profile.queries,
+                profile.sql_time * 1000, profile.render_time * 1000,
+                profile.slowest_time * 1000,
+                (profile.slowest_statement or '')[:300]))
+
+    try:
+        pipe = redis_conn.pipeline()
+        hist = cache.key('profile:' + route)
+        pipe.hincrby(hist, bucket_for(elapsed_ms), 1)
+        pipe.hincrby(hist, 'count', 1)
+        pipe.hincrby(hist, 'queries', profile.queries)
+        pipe.hincrbyfloat(hist, 'sql_ms', profile.sql_time * 1000)
+        pipe.hincrbyfloat(hist, 'render_ms', profile.render_time * 1000)
+        pipe.hincrbyfloat(hist, 'total_ms', elapsed_ms)
+        pipe.sadd(cache.key('profile_routes'), route)
+        pipe.execute()
+    except RedisError:
+        current_app.logger.warn("Unable to record request profile",
+                                exc_info=True)
+
+
+def route_stats():
+    """ Summarises the recorded histograms per route, estimating percentiles
+    as the upper bound of the bucket they fall in """
+    stats = {}
+    for route in redis_conn.smembers(cache.key('profile_routes')):
+        if isinstance(route, bytes):
+            route = route.decode('utf8')
+        raw = dict((k.decode('utf8') if isinstance(k, bytes) else k, float(v))
+                   for k, v in redis_conn.hgetall(cache.key('profile:' + route)).items())
+        count = raw.get('count', 0)
+        if not count:
+            continue
+        bounds = [str(b) for b in BUCKETS] + ['inf']
+
+        def percentile(pct):
+            seen = 0
+            for bound in bounds:
+                seen += raw.get(bound, 0)
+                if seen >= count * pct / 100.0:
+                    return bound
+            return 'inf'
+
+        stats[route] = dict(count=int(count),
+                            p50_ms=percentile(50),
+                            p90_ms=percentile(90),
+                            p99_ms=percentile(99),
+                            avg_ms=raw.get('total_ms', 0) / count,
+                            avg_sql_ms=raw.get('sql_ms', 0) / count,
+                            avg_render_ms=raw.get('render_ms', 0) / count,
+                            avg_queries=raw.get('queries', 0) / count)
+    return stats
+
+
+_listening = []
+
+
+def init_app(app):
+    app.jinja_env.template_class = ProfiledTemplate
+    app.before_request(start_request)
+    app.after_request(add_header)
+    app.teardown_request(finish_request)
+    # Engine events are global, so only hook them up once per process
+    if not _listening:
+        sqlalchemy.event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        sqlalchemy.event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        _listening.append(True)
@@ -0,0 +1,292 @@
+""" Optional pruned storage. Once every output of a transaction has been spent
+more than `prune_depth` blocks below the tip, its Output rows are packed into
+compressed per transaction blobs in output_archive and deleted. Transaction,
+Block and Address rows and their totals are left alone, and the transaction
+page unpacks the blobs when it shows a pruned transaction.
+
+Each output is archived twice: with the transaction that created it and with
+the one that spent it, since the transaction page lists both.
+output_archive_address records which archived transactions paid each address,
+so address history can unpack their outputs when a page reaches them. Pruning works
+forward through spend heights a few blocks per step, in the background with
+`manage.py prune --follow`, or optionally from sync after each block. """
+import struct
+import zlib
+from decimal import Decimal
+
+import sqlalchemy
+from flask import current_app
+from redis.exceptions import RedisError
+from sqlalchemy.orm import aliased
+
+from lincoln.utils import hash_str as encode_hash
+
+from . import db, redis_conn, cache
+from .models import Transaction, Output, OutputArchive, OutputArchiveAddress
+
+# Deep enough that a fork rollback never reaches a pruned block
+MIN_DEPTH = 100
+# Output index, type, amount in satoshis and address hash length
+ENTRY = struct.Struct('<HBqB')
+# Keeps IN lists under SQLite's bound parameter limit
+IN_CHUNK = 500
+
+
+def depth():
+    """ The configured prune depth, or 0 when pruning is off """
+    depth = int(current_app.config.get('prune_depth', 0) or 0)
+    if depth and depth < MIN_DEPTH:
+        raise ValueError("prune_depth must be at least {}".format(MIN_DEPTH))
+    return depth
+
+
+def enabled():
+    return bool(current_app.config.get('prune_depth'))
+
+
+class SpentIn(object):
+    """ Stands in for the spending Transaction of an archived output, which
+    is all output_table.html reads from it """
+    def __init__(self, txid):
+        self.txid = txid
+
+    @property
+    def hash_str(self):
+        return encode_hash(self.txid)
+
+
+class ArchivedOutput(object):
+    """ An unpacked Output, rendered by the same templates """
+    type_map_str = Output.type_map_str
+    type_map_color = Output.type_map_color
+    type_map_icon = Output.type_map_icon
+    type_icon = Output.type_icon
+    type_color = Output.type_color
+    type_str = Output.type_str
+    dest_address = Output.dest_address
+    address_str = Output.address_str
+
+    def __init__(self, origin_tx_hash, index, type, amount, address_hash,
+                 spent_tx, height=None):
+        self.origin_tx_hash = origin_tx_hash
+        self.height = height
+        self.index = index
+        self.type = type
+        self.amount = amount
+        self.address_hash = address_hash
+        self.spent_tx = spent_tx
+
+
+def pack(entries):
+    """ Packs (index, type, amount, address hash, txid) tuples, where txid is
+    the spender for created outputs and the origin for spent ones """
+    parts = []
+    for index, type, amount, address_hash, txid in entries:
+        address_hash = address_hash or b''
+        parts.append(ENTRY.pack(index, type,
+                                int(amount * 100000000), len(address_hash)))
+        parts.append(address_hash)
+        parts.append(txid)
+    return zlib.compress(b''.join(parts))
+
+
+def unpack(blob):
+    if not blob:
+        return []
+    raw = zlib.decompress(blob)
+    entries = []
+    pos = 0
+    while pos < len(raw):
+        index, type, satoshis, address_len = ENTRY.unpack_from(raw, pos)
+        pos += ENTRY.size
+        address_hash = raw[pos:pos + address_len] or None
+        pos += address_len
+        txid = raw[pos:pos + 32]
+        pos += 32
+        entries.append((index, type, Decimal(satoshis) / 100000000,
+                        address_hash, txid))
+    return entries
+
+
+def archived_outputs(transaction):
+    """ The pruned (spent, created) outputs of a transaction, or empty lists
+    if none of its outputs have been pruned """
+    if not enabled():
+        return [], []
+    archive = OutputArchive.query.get(transaction.id)
+    if archive is None:
+        return [], []
+    spent = [ArchivedOutput(origin, index, type, amount, address_hash, None)
+             for index, type, amount, address_hash, origin
+             in unpack(archive.spent)]
+    spent.sort(key=lambda o: (o.origin_tx_hash, o.index))
+    created = [ArchivedOutput(transaction.txid, index, type, amount,
+                              address_hash, SpentIn(spender))
+               for index, type, amount, address_hash, spender
+               in unpack(archive.created)]
+    created.sort(key=lambda o: o.index)
+    return spent, created
+
+
+def address_outputs(address_hash, limit, before=None, after=None):
+    """ Up to `limit` pruned outputs paid to an address, in the order address
+    history lists outputs: newest first by block, txid and index. With a
+    (height, txid, index) `before` cursor they start just below it, and with
+    an `after` cursor they're the ones just above it, oldest first """
+    if not enabled():
+        return []
+    key = sqlalchemy.tuple_(OutputArchiveAddress.height, OutputArchiveAddress.txid)
+    rows = OutputArchiveAddress.query.filter_by(address_hash=address_hash)
+    if after is not None:
+        rows = (rows.filter(key >= sqlalchemy.tuple_(*after[:2]))
+                .order_by(OutputArchiveAddress.height, OutputArchiveAddress.txid))
+    else:
+        if before is not None:
+            rows = rows.filter(key <= sqlalchemy.tuple_(*before[:2]))
+        rows = rows.order_by(OutputArchiveAddress.height.desc(),
+                             OutputArchiveAddress.txid.desc())
+    # The cursor's own transaction may have nothing left on this side of it
+    rows = rows.limit(limit + 1).all()
+    archives = {}
+    for chunk in _chunks(row.tx_id for row in rows):
+        for archive in OutputArchive.query.filter(OutputArchive.tx_id.in_(chunk)):
+            archives[archive.tx_id] = archive
+
+    outputs = []
+    for row in rows:
+        entries = sorted((e for e in unpack(archives[row.tx_id].created)
+                          if e[3] == address_hash), reverse=after is None)
+        for index, type, amount, _, spender in entries:
+            position = (row.height, row.txid, index)
+            if ((before is not None and position >= before) or
+                    (after is not None and position <= after)):
+                continue
+            outputs.append(ArchivedOutput(row.txid, index, type, amount,
+                                          address_hash, SpentIn(spender),
+                                          row.height))
+        if len(outputs) >= limit:
+            break
+    return outputs[:limit]
+
+
+def _chunks(values):
+    values = list(values)
+    for i in range(0, len(values), IN_CHUNK):
+        yield values[i:i + IN_CHUNK]
+
+
+def pruned_height():
+    """ Spend height that pruning has worked through. Kept in redis, and if
+    that's lost recovered from the archive, which at worst repeats some
+    work since pruning an already pruned height finds nothing to do """
+    try:
+        height = redis_conn.get(cache.key('pruned_height'))
+    except RedisError:
+        height = None
+    if height is not None:
+        return int(height)
+    return (db.session.query(sqlalchemy.func.max(OutputArchive.height))
+            .filter(OutputArchive.spent.isnot(None)).scalar()) or 0
+
+
+def reset():
+    """ Forgets prune progress, for when the database has been replaced """
+    redis_conn.delete(cache.key('pruned_height'))
+
+
+def prune_range(low, high):
+    """ Archives and deletes the outputs of every transaction left fully
+    spent by the spends in blocks `low` through `high`. Returns the number
+    of transactions pruned """
+    spender = aliased(Transaction)
+    origins = set(
+        txid for txid, in
+        db.session.query(Output.origin_tx_hash.distinct())
+        .join(spender, spender.id == Output.spend_tx_id)
+        .filter(spender.height.between(low, high)))
+
+    # Transactions with an output that's unspent, or spent too recently,
+    # stay as they are. That includes anything with an OP_RETURN output,
+    # which the schema can't tell apart from other non-standard outputs
+    prunable = set()
+    for chunk in _chunks(origins):
+        unsafe = sqlalchemy.func.sum(sqlalchemy.case(
+            [(sqlalchemy.or_(spender.height.is_(None), spender.height > high), 1)],
+            else_=0))
+        prunable.update(
+            txid for txid, in
+            db.session.query(Output.origin_tx_hash)
+            .outerjoin(spender, spender.id == Output.spend_tx_id)
+            .filter(Output.origin_tx_hash.in_(chunk))
+            .group_by(Output.origin_tx_hash)
+            .having(unsafe == 0))
+    if not prunable:
+        return 0
+
+    origin = aliased(Transaction)
+    created = {}
+    spent = {}
+    heights = {}
+    txids = {}
+    for chunk in _chunks(prunable):
+        rows = (db.session.query(Output, origin.id, origin.height,
+                                 spender.id, spender.height, spender.txid)
+                .join(origin, origin.txid == Output.origin_tx_hash)
+                .join(spender, spender.id == Output.spend_tx_id)
+                .filter(Output.origin_tx_hash.in_(chunk)))
+        for out, origin_id, origin_height, spender_id, spender_height, spender_txid in rows:
+            heights[origin_id] = origin_height
+            txids[origin_id] = out.origin_tx_hash
+            heights[spender_id] = spender_height
+            created.setdefault(origin_id, []).append(
+                (out.index, out.type, out.amount, out.address_hash, spender_txid))
+            spent.setdefault(spender_id, []).append(
+                (out.index, out.type, out.amount, out.address_hash, out.origin_tx_hash))
+
+    # A transaction can gain archived inputs over several steps, so merge
+    # with what's already been archived for it
+    existing = {}
+    for chunk in _chunks(heights):
+        for archive in OutputArchive.query.filter(OutputArchive.tx_id.in_(chunk)):
+            existing[archive.tx_id] = archive
+    for tx_id, height in heights.items():
+        archive = existing.get(tx_id)
+        if archive is None:
+            archive = OutputArchive(tx_id=tx_id, height=height)
+            db.session.add(archive)
+        if tx_id in created:
+            archive.created = pack(created[tx_id])
+            for address_hash in set(e[3] for e in created[tx_id] if e[3]):
+                db.session.add(OutputArchiveAddress(
+                    address_hash=address_hash, height=height,
+                    txid=txids[tx_id], tx_id=tx_id))
+        if tx_id in spent:
+            archive.spent = pack(unpack(archive.spent) + spent[tx_id])
+
+    for chunk in _chunks(prunable):
+        (Output.query.filter(Output.origin_tx_hash.in_(chunk))
+         .delete(synchronize_session=False))
+    return len(prunable)
+
+
+def step(tip_height, max_blocks):
+    """ Prunes up to `max_blocks` more spend heights, stopping `prune_depth`
+    below `tip_height`. Commits, and returns the number of transactions
+    pruned """
+    prune_depth = depth()
+    if not prune_depth:
+        return 0
+    low = pruned_height() + 1
+    high = min(tip_height - prune_depth, low + max_blocks - 1)
+    if high < low:
+        return 0
+
+    pruned = prune_range(low, high)
+    db.session.commit()
+    try:
+        redis_conn.set(cache.key('pruned_height'), high)
+    except RedisError:
+        current_app.logger.warn("Unable to record prune progress", exc_info=True)
+    current_app.logger.debug("Pruned {:,} transactions spent in blocks {:,} to {:,}"
+                             .format(pruned, low, high))
+    return pruned
@@ -0,0 +1,141 @@
+""" Addresses ranked by balance, and how balances are distributed. Sync keeps
+Address.balance_satoshis current through a BalanceTracker for each block it
+adds or rolls back, so the top of the list and any address's rank come
+straight off the balance index. The tracker also moves addresses between
+BalanceBucket rows as their balances change, which keeps the distribution
+down to reading a couple of dozen rows. """
+from decimal import Decimal
+
+import sqlalchemy
+
+from . import db
+from .models import Address, BalanceBucket
+
+
+def satoshis(amount):
+    return int(amount * 100000000)
+
+
+def bucket_for(balance):
+    """ Number of digits in a satoshi balance, so each bucket spans a factor
+    of ten. Empty addresses are bucket 0 """
+    return len(str(balance)) if balance > 0 else 0
+
+
+def bucket_range(bucket):
+    """ (lowest, highest) balance in coins a bucket covers """
+    if not bucket:
+        return Decimal(0), Decimal(0)
+    return (Decimal(10 ** (bucket - 1)) / 100000000,
+            Decimal(10 ** bucket - 1) / 100000000)
+
+
+class BalanceTracker(object):
+    """ Applies the balance changes of one block to its addresses, and then
+    folds their net movement between buckets into balance_bucket """
+
+    def __init__(self):
+        # Balance of each touched address before the block, or None for
+        # addresses the block created
+        self.before = {}
+
+    def _touch(self, address, new):
+        if address not in self.before:
+            self.before[address] = None if new else address.balance_satoshis
+
+    def credit(self, address, amount, new=False):
+        self._touch(address, new)
+        address.balance_satoshis += amount
+
+    def debit(self, address, amount):
+        self._touch(address, False)
+        address.balance_satoshis -= amount
+
+    def flush(self):
+        deltas = {}
+        for address, before in self.before.items():
+            if before is not None:
+                count, total = deltas.get(bucket_for(before), (0, 0))
+                deltas[bucket_for(before)] = (count - 1, total - before)
+            after = address.balance_satoshis
+            count, total = deltas.get(bucket_for(after), (0, 0))
+            deltas[bucket_for(after)] = (count + 1, total + after)
+        self.before.clear()
+
+        for bucket, (count, total) in sorted(deltas.items()):
+            if not count and not total:
+                continue
+            updated = (BalanceBucket.query.filter_by(bucket=bucket)
+                       .update({BalanceBucket.addresses: BalanceBucket.addresses + count,
+                                BalanceBucket.total: BalanceBucket.total + total},
+                               synchronize_session=False))
+            if not updated:
+                db.session.add(BalanceBucket(bucket=bucket, addresses=count,
+                                             total=total))
+        db.session.flush()
+
+
+def top(limit, offset=0):
+    """ The richest addresses, as (rank, address) pairs """
+    addresses = (Address.query
+                 .order_by(Address.balance_satoshis.desc(), Address.id)
+                 .offset(offset)
+                 .limit(limit))
+    return [(offset + i + 1, address) for i, address in enumerate(addresses)]
+
+
+def rank(address):
+    """ 1 for the richest address. Addresses with equal balances share a rank.
+    Richer buckets are counted from balance_bucket, so only the address's
+    own bucket is counted off the balance index """
+    balance = address.balance_satoshis
+    bucket = bucket_for(balance)
+    richer = (db.session.query(sqlalchemy.func.sum(BalanceBucket.addresses))
+              .filter(BalanceBucket.bucket > bucket).scalar()) or 0
+    # Smallest balance in the next bucket up
+    ceiling = 10 ** bucket if bucket else 1
+    richer += (Address.query
+               .filter(Address.balance_satoshis > balance,
+                       Address.balance_satoshis < ceiling)
+               .count())
+    return int(richer) + 1
+
+
+def distribution():
+    rows = (BalanceBucket.query.filter(BalanceBucket.addresses > 0)
+            .order_by(BalanceBucket.bucket))
+    return [dict(bucket=row.bucket,
+                 low=bucket_range(row.bucket)[0],
+                 high=bucket_range(row.bucket)[1],
+                 addresses=row.addresses,
+                 total=Decimal(row.total) / 100000000)
+            for row in rows]
+
+
+def rebuild():
+    """ Recomputes every balance from the address totals, and the buckets
+    from the balances. For upgrades and repairs; sync keeps both current """
+    # Cast, since SqliteNumeric can't take part in arithmetic once it's been
+    # used with SQLite
+    balance = (sqlalchemy.cast(Address.total_in, sqlalchemy.Numeric) -
+               sqlalchemy.cast(Address.total_out, sqlalchemy.Numeric))
+    db.session.query(Address).update(
+        {Address.balance_satoshis: sqlalchemy.cast(
+            sqlalchemy.func.round(balance * 100000000), sqlalchemy.BigInteger)},
+        synchronize_session=False)
+    rebuild_buckets()
+
+
+def rebuild_buckets():
+    bucket = sqlalchemy.case(
+        [(Address.balance_satoshis > 0,
+          sqlalchemy.func.length(sqlalchemy.cast(Address.balance_satoshis,
+                                                 sqlalchemy.String)))],
+        else_=0)
+    rows = (db.session.query(bucket, sqlalchemy.func.count(),
+                             sqlalchemy.func.sum(Address.balance_satoshis))
+            .group_by(bucket).all())
+    BalanceBucket.query.delete(synchronize_session=False)
+    for b, count, total in rows:
+        db.session.add(BalanceBucket(bucket=b, addresses=count, total=total or 0))
+    db.session.commit()
@@ -0,0 +1,95 @@
+import itertools
+import threading
+import time
+from functools import partial
+
+import sqlalchemy
+from flask import current_app, g, has_request_context
+from flask.ext.sqlalchemy import SQLAlchemy, _SignallingSession
+from sqlalchemy import orm
+from sqlalchemy.engine.url import make_url
+
+
+class RoutingSession(_SignallingSession):
+    """ Session that sends queries issued while serving a read only request
+    to a replica. Flushes, and therefore all writes, always go to the
+    primary, as does everything outside of a request such as sync """
+
+    def get_bind(self, mapper=None, clause=None):
+        if (not self._flushing and has_request_context() and
+                getattr(g, 'read_only', False)):
+            engine = replica_for_request()
+            if engine is not None:
+                return engine
+        return _SignallingSession.get_bind(self, mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_scoped_session(self, options=None):
+        if options is None:
+            options = {}
+        scopefunc = options.pop('scopefunc', None)
+        return orm.scoped_session(
+            partial(RoutingSession, self, **options), scopefunc=scopefunc)
+
+
+class ReplicaRouter(object):
+    """ Hands out replica engines round-robin, skipping any replica whose
+    highest block lags too far behind what sync last reported """
+
+    def __init__(self, app, db, uris):
+        self.engines = []
+        for uri in uris:
+            info = make_url(uri)
+            options = {'convert_unicode': True}
+            db.apply_pool_defaults(app, options)
+            db.apply_driver_hacks(app, info, options)
+            self.engines.append(sqlalchemy.create_engine(info, **options))
+
+        self.max_lag = int(app.config.get('replica_max_lag', 3))
+        self.check_interval = float(app.config.get('replica_check_interval', 5))
+        self._cycle = itertools.cycle(self.engines)
+        # engine -> (checked at, height or None if unreachable)
+        self._heights = {}
+        self._lock = threading.Lock()
+
+    def replica_height(self, engine):
+        checked_at, height = self._heights.get(engine, (0, None))
+        if time.time() - checked_at < self.check_interval:
+            return height
+
+        try:
+            height = engine.execute(
+                sqlalchemy.text("SELECT max(height) FROM block")).scalar()
+        except sqlalchemy.exc.SQLAlchemyError:
+            current_app.logger.warn("Replica {} is unreachable"
+                                    .format(engine.url), exc_info=True)
+            height = None
+        self._heights[engine] = (time.time(), height)
+        return height
+
+    def pick(self):
+        """ Returns the next fresh replica engine, or None if every replica
+        is stale or down and the primary should be used """
+        from . import cache
+        status = cache.sync_status()
+
+        with self._lock:
+            for _ in range(len(self.engines)):
+                engine = next(self._cycle)
+                height = self.replica_height(engine)
+                if height is None:
+                    continue
+                # Without any sync status there's nothing to compare with
+                if status is None or status['height'] - height <= self.max_lag:
+                    return engine
+        return None
+
+
+def replica_for_request():
+    """ Picks a replica once per request, so that every query in a request
+    sees the same snapshot """
+    if not hasattr(g, 'replica_engine'):
+        router = getattr(current_app, 'replica_router', None)
+        g.replica_engine = router.pick() if router else None
+    return g.replica_engine
@@ -0,0 +1,54 @@
+""" Settings for serving many concurrent requests per worker. With gunicorn's
+gevent worker a request waiting on postgres or redis yields to the others, so
+a worker holds hundreds of mostly idle requests instead of one. That makes
+the shared connection pools and a cap on how long any one statement can run
+matter, all configured here from keys read in create_app. """
+import sqlalchemy
+from flask import current_app, g, has_request_context
+from redis import Redis, BlockingConnectionPool
+
+from lincoln.routing import RoutingSession
+
+
+def redis_client(app, redis_config):
+    """ One client per process, backed by a pool that greenlets share and
+    wait on when all its connections are busy rather than opening more """
+    pool = BlockingConnectionPool(
+        max_connections=int(app.config.get('redis_pool_size', 50)),
+        timeout=int(app.config.get('redis_pool_timeout', 5)),
+        **redis_config)
+    return Redis(connection_pool=pool)
+
+
+def set_statement_timeout(session, transaction, connection):
+    """ Caps every statement a web request runs, so one pathological page
+    fails fast instead of pinning a connection. Sync isn't affected """
+    timeout = int(current_app.config.get('statement_timeout_ms', 0) or 0)
+    if not timeout or connection.dialect.name != 'postgresql':
+        return
+    if not has_request_context() or not getattr(g, 'read_only', False):
+        return
+    connection.execute("SET LOCAL statement_timeout = {:d}".format(timeout))
+
+
+def gevent_patched():
+    """ Whether we're running under gevent's monkey patching, as gunicorn's
+    gevent worker does before it loads the app """
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched('socket')
+
+
+def init_app(app):
+    if gevent_patched():
+        # psycopg2 blocks in C, this makes it wait on postgres cooperatively
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
+
+    if app.config.get('statement_timeout_ms'):
+        if not sqlalchemy.event.contains(RoutingSession, 'after_begin',
+                                         set_statement_timeout):
+            sqlalchemy.event.listen(RoutingSession, 'after_begin',
+                                    set_statement_timeout)
@@ -0,0 +1,342 @@
+import csv
+import datetime
+import gzip
+import hashlib
+import json
+import os
+from decimal import Decimal
+
+import sqlalchemy
+import sqlalchemy.types as types
+from flask import current_app
+
+from lincoln.model_lib import SqliteNumeric
+from lincoln.utils import hash_str as encode_hash
+from . import db, cache, partitioning, bloom, pruning, richlist, charts
+from .models import Block, Transaction, Output, Address, OutputArchive
+
+FORMAT_VERSION = 1
+# Parents first, so foreign keys hold once constraints are restored
+TABLES = (Block.__table__, Transaction.__table__, Address.__table__,
+          Output.__table__)
+
+
+def encode_value(value):
+    """ Encodes a column value the way postgres' COPY ... (FORMAT csv) reads
+    it back. NULL is an empty unquoted field """
+    if value is None:
+        return None
+    if isinstance(value, bytes):
+        return '\\x' + value.hex()
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, datetime.datetime):
+        return value.isoformat(' ')
+    return str(value)
+
+
+def decoder_for(column):
+    """ Inverse of encode_value for a column, used where COPY isn't available """
+    typ = column.type
+    if isinstance(typ, types.LargeBinary):
+        return lambda v: bytes.fromhex(v[2:])
+    if isinstance(typ, types.Boolean):
+        return lambda v: v == 't'
+    if isinstance(typ, types.DateTime):
+        return lambda v: datetime.datetime.strptime(
+            v, '%Y-%m-%d %H:%M:%S.%f' if '.' in v else '%Y-%m-%d %H:%M:%S')
+    if isinstance(typ, (types.Numeric, SqliteNumeric)):
+        return Decimal
+    if isinstance(typ, types.Integer):
+        return int
+    if isinstance(typ, types.Float):
+        return float
+    return lambda v: v
+
+
+def sha256_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class ChunkWriter(object):
+    """ Splits a stream of rows across gzipped csv files of at most
+    chunk_rows rows, recording each file's row count and checksum """
+
+    def __init__(self, directory, name, chunk_rows):
+        self.directory = directory
+        self.name = name
+        self.chunk_rows = chunk_rows
+        self.chunks = []
+        self.rows = 0
+        self.file = None
+
+    def _open(self):
+        filename = "{}.{:05d}.csv.gz".format(self.name, len(self.chunks))
+        self.chunks.append(dict(file=filename, rows=0))
+        self.file = gzip.open(os.path.join(self.directory, filename), 'wt',
+                              newline='')
+        self.writer = csv.writer(self.file)
+
+    def _close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            chunk = self.chunks[-1]
+            chunk['sha256'] = sha256_file(os.path.join(self.directory, chunk['file']))
+
+    def write(self, row):
+        if self.file is None:
+            self._open()
+        self.writer.writerow([encode_value(v) for v in row])
+        self.chunks[-1]['rows'] += 1
+        self.rows += 1
+        if self.chunks[-1]['rows'] >= self.chunk_rows:
+            self._close()
+
+    def finish(self):
+        self._close()
+        return dict(rows=self.rows, chunks=self.chunks)
+
+
+def export_queries(height):
+    """ Selects every table as it stood right after block `height`, as
+    (table, query, row transform) tuples. Sync inserts strictly by height and
+    rollbacks delete from the top, so every transaction id up to the highest
+    one at `height` belongs to a block at or below it. Spends from later
+    blocks are dropped and address totals are recomputed to match """
+    block, tx, address, output = TABLES
+    max_tx_id = (db.session.query(sqlalchemy.func.max(tx.c.id))
+                 .join(block, block.c.id == tx.c.block_id)
+                 .filter(block.c.height <= height).scalar()) or 0
+
+    spent = output.c.spend_tx_id <= max_tx_id
+    output_columns = [
+        sqlalchemy.case([(spent, c)], else_=None).label(c.name)
+        if c.name == 'spend_tx_id' else c for c in output.c]
+
+    # Sum whole satoshis, since SQLite would otherwise sum the amount
+    # strings as floats
+    satoshis = sqlalchemy.cast(sqlalchemy.func.round(output.c.amount * 100000000),
+                               sqlalchemy.BigInteger)
+    spent_satoshis = sqlalchemy.func.sum(
+        sqlalchemy.case([(spent, satoshis)], else_=0))
+    totals = {'total_in': sqlalchemy.func.sum(satoshis),
+              'total_out': spent_satoshis,
+              'balance': sqlalchemy.func.sum(satoshis) - spent_satoshis}
+    address_columns = [totals[c.name].label(c.name) if c.name in totals else c
+                       for c in address.c]
+    # The balance stays in satoshis
+    total_positions = [i for i, c in enumerate(address.c)
+                       if c.name in ('total_in', 'total_out')]
+
+    def address_row(row):
+        row = list(row)
+        for i in total_positions:
+            row[i] = Decimal(row[i]) / 100000000
+        return row
+
+    return [
+        (block, sqlalchemy.select(list(block.c))
+         .where(block.c.height <= height).order_by(block.c.id), None),
+        (tx, sqlalchemy.select(list(tx.c))
+         .where(tx.c.id <= max_tx_id).order_by(tx.c.id), None),
+        (address, sqlalchemy.select(address_columns)
+         .select_from(address.join(output, output.c.address_hash == address.c.hash)
+                      .join(tx, tx.c.txid == output.c.origin_tx_hash))
+         .where(tx.c.id <= max_tx_id)
+         .group_by(*address.c).order_by(address.c.id), address_row),
+        (output, sqlalchemy.select(output_columns)
+         .select_from(output.join(tx, tx.c.txid == output.c.origin_tx_hash))
+         .where(tx.c.id <= max_tx_id)
+         .order_by(output.c.origin_tx_hash, output.c.index), None),
+    ]
+
+
+def export(directory, height, chunk_rows=1000000):
+    """ Writes the database as of block `height` into `directory` as chunked
+    gzipped csv files plus a manifest.json describing them """
+    block = Block.query.filter_by(height=height).one()
+    # Address totals are recomputed from the outputs, which a pruned
+    # database no longer has
+    if OutputArchive.query.first() is not None:
+        raise ValueError("Can't export a snapshot from a pruned database")
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    manifest = dict(format=FORMAT_VERSION,
+                    height=height,
+                    block_hash=encode_hash(block.hash),
+                    currency=current_app.config['currency']['code'],
+                    created_at=datetime.datetime.utcnow().isoformat(),
+                    tables={})
+
+    conn = db.engine.connect().execution_options(stream_results=True)
+    try:
+        for table, query, transform in export_queries(height):
+            writer = ChunkWriter(directory, table.name, chunk_rows)
+            result = conn.execute(query)
+            while True:
+                rows = result.fetchmany(10000)
+                if not rows:
+                    break
+                for row in rows:
+                    writer.write(transform(row) if transform else row)
+            info = writer.finish()
+            info['columns'] = [c.name for c in table.c]
+            manifest['tables'][table.name] = info
+            current_app.logger.info("Exported {:,} {} rows in {:,} chunks"
+                                    .format(info['rows'], table.name,
+                                            len(info['chunks'])))
+    finally:
+        conn.close()
+
+    with open(os.path.join(directory, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+def read_manifest(directory):
+    with open(os.path.join(directory, 'manifest.json')) as f:
+        manifest = json.load(f)
+    if manifest.get('format') != FORMAT_VERSION:
+        raise ValueError("Unsupported snapshot format {}"
+                         .format(manifest.get('format')))
+    if manifest['currency'] != current_app.config['currency']['code']:
+        raise ValueError("Snapshot is of {}, not {}".format(
+            manifest['currency'], current_app.config['currency']['code']))
+    for table in TABLES:
+        info = manifest['tables'].get(table.name)
+        if info is None:
+            raise ValueError("Snapshot has no {} table".format(table.name))
+        if info['columns'] != [c.name for c in table.c]:
+            raise ValueError("Snapshot {} columns don't match the schema"
+                             .format(table.name))
+    return manifest
+
+
+def verify(directory, manifest):
+    """ Checks every chunk against the manifest before anything is dropped """
+    for name, info in manifest['tables'].items():
+        for chunk in info['chunks']:
+            path = os.path.join(directory, chunk['file'])
+            if sha256_file(path) != chunk['sha256']:
+                raise ValueError("Checksum mismatch for {}".format(chunk['file']))
+
+
+def _quote(name):
+    return db.engine.dialect.identifier_preparer.quote(name)
+
+
+def _drop_postgres_constraints(conn):
+    """ Drops primary key, unique and foreign key constraints on the explorer
+    tables, returning their definitions so they can be put back """
+    constraints = conn.execute(sqlalchemy.text(
+        "SELECT conrelid::regclass::text, conname, contype, "
+        "pg_get_constraintdef(oid) FROM pg_constraint "
+        "WHERE contype IN ('p', 'u', 'f') AND conrelid IN "
+        "(SELECT oid FROM pg_class WHERE relname IN :names)"),
+        names=tuple(t.name for t in TABLES)).fetchall()
+    # Foreign keys depend on the keys they reference, so they go first
+    for table, name, kind, _ in sorted(constraints, key=lambda c: c[2] != 'f'):
+        conn.execute('ALTER TABLE {} DROP CONSTRAINT {}'.format(table, _quote(name)))
+    return constraints
+
+
+def _add_postgres_constraints(conn, constraints):
+    for table, name, kind, definition in constraints:
+        conn.execute('ALTER TABLE {} ADD CONSTRAINT {} {}'
+                     .format(table, _quote(name), definition))
+
+
+def _copy_postgres(conn, table, columns, path):
+    cursor = conn.connection.cursor()
+    with gzip.open(path, 'rt', newline='') as f:
+        cursor.copy_expert('COPY {} ({}) FROM STDIN WITH (FORMAT csv)'
+                           .format(_quote(table.name),
+                                   ', '.join(_quote(c) for c in columns)), f)
+
+
+def _insert_rows(conn, table, columns, path):
+    decoders = [decoder_for(table.c[c]) for c in columns]
+    with gzip.open(path, 'rt', newline='') as f:
+        batch = []
+        for row in csv.reader(f):
+            batch.append(dict((c, dec(v) if v != '' else None)
+                              for c, dec, v in zip(columns, decoders, row)))
+            if len(batch) >= 10000:
+                conn.execute(table.insert(), batch)
+                batch = []
+        if batch:
+            conn.execute(table.insert(), batch)
+
+
+def load(directory):
+    """ Recreates the explorer tables from a snapshot. Indexes, and on
+    postgres constraints too, are only created once all rows are in, which
+    is far cheaper than maintaining them row by row """
+    manifest = read_manifest(directory)
+    verify(directory, manifest)
+
+    db.session.commit()
+    db.drop_all()
+    db.create_all()
+    partitioning.ensure_partitions(db.engine, db.metadata, manifest['height'])
+
+    postgres = db.engine.dialect.name == 'postgresql'
+    conn = db.engine.connect()
+    trans = conn.begin()
+    try:
+        constraints = _drop_postgres_constraints(conn) if postgres else []
+        indexes = [i for t in TABLES for i in t.indexes]
+        for index in indexes:
+            index.drop(conn)
+
+        for table in TABLES:
+            info = manifest['tables'][table.name]
+            for chunk in info['chunks']:
+                path = os.path.join(directory, chunk['file'])
+                if postgres:
+                    _copy_postgres(conn, table, info['columns'], path)
+                else:
+                    _insert_rows(conn, table, info['columns'], path)
+            current_app.logger.info("Loaded {:,} {} rows"
+                                    .format(info['rows'], table.name))
+
+        # Keys first, then indexes, since address.hash is only unique
+        # through its index, and foreign keys last as they need both
+        _add_postgres_constraints(conn, [c for c in constraints if c[2] != 'f'])
+        for index in indexes:
+            index.create(conn)
+        _add_postgres_constraints(conn, [c for c in constraints if c[2] == 'f'])
+        current_app.logger.info("Restored indexes and constraints")
+
+        if postgres:
+            # COPY doesn't advance the id sequences
+            for table in TABLES:
+                if 'id' in table.c:
+                    conn.execute(sqlalchemy.text(
+                        "SELECT setval(pg_get_serial_sequence(:table, 'id'), "
+                        "coalesce(max(id), 0) + 1, false) FROM {}"
+                        .format(_quote(table.name))), table=_quote(table.name))
+        trans.commit()
+    except Exception:
+        trans.rollback()
+        raise
+    finally:
+        conn.close()
+
+    if postgres:
+        conn = db.engine.connect().execution_options(isolation_level='AUTOCOMMIT')
+        conn.execute('ANALYZE')
+        conn.close()
+
+    richlist.rebuild_buckets()
+    charts.rebuild()
+    cache.rebuild_block_ring()
+    bloom.reset()
+    pruning.reset()
+    return manifest
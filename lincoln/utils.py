@@ -1,8 +1,15 @@
 from bitcoin.core import serialize
 from flask import current_app
+from functools import lru_cache
+import bitcoin.base58 as base58
+import bitcoin.core as core
 import bitcoin.core.script as op
 import time
 
+# Number of encoded hash/address strings kept around for display. A listing
+# page touches a few hundred at most, so this covers many concurrent pages
+DISPLAY_CACHE_SIZE = 16384
+
 
 class Benchmark(object):
     def __init__(self, name):
@@ -27,6 +34,23 @@ def time_format(seconds):
     return "{:,.4f} sec".format(seconds)
 
 
+@lru_cache(maxsize=DISPLAY_CACHE_SIZE)
+def hash_str(raw):
+    """
+    Memoized little-endian hex string of a raw block or transaction hash
+    """
+    return core.b2lx(raw)
+
+
+@lru_cache(maxsize=DISPLAY_CACHE_SIZE)
+def address_str(raw, version):
+    """
+    Memoized base58check string of a raw address hash. Encoding runs a
+    SHA256d for the checksum, so repeated addresses on a page add up
+    """
+    return str(base58.CBase58Data.from_bytes(raw, nVersion=version))
+
+
 def get_int_from_str(str):
     """
     Takes a string, convert it to an int or returns False
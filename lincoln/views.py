@@ -1,41 +1,184 @@
+import binascii
+import datetime
+import heapq
 import os
 import bitcoin.core as core
+import sqlalchemy
 
 from flask import render_template, Blueprint, send_from_directory, current_app, \
-    g, request
+    g, request, Response, stream_with_context, jsonify, abort
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import joinedload
 
 from . import models as m
-from . import root
+from . import root, cache, feed, bloom, pruning, richlist, charts
 
 main = Blueprint('main', __name__)
 
 
 @main.before_request
 def glob_vars():
+    # Views only read, so their queries may be served by a replica
+    g.read_only = True
     g.currency = current_app.config['currency']['name']
     g.assets_address = current_app.config['assets_address']
     g.rev_hash = current_app.config['hash']
     if 'currencies' in current_app.config:
         g.currencies = current_app.config['currencies']
+    g.sync_status = cache.sync_status()
+    g.sync_lag_warning = int(current_app.config.get('sync_lag_warning', 5))
+    g.sync_stale_seconds = int(current_app.config.get('sync_stale_seconds', 600))
 
 
-@main.route('/address/<address>')
-def address(address):
+@main.errorhandler(OperationalError)
+def statement_timeout(e):
+    # Raised when a query runs past statement_timeout_ms
+    if 'statement timeout' not in str(e.orig):
+        raise e
+    return "This page took too long to load, please try again later.", 503
+
+
+def stream_template(template_name, **context):
+    """ Renders a template as a generator, so that large tables are sent
+    to the client as their rows are produced instead of being built up into
+    one big string first """
+    current_app.update_template_context(context)
+    template = current_app.jinja_env.get_template(template_name)
+    rv = template.stream(context)
+    rv.enable_buffering(20)
+    return Response(stream_with_context(rv))
+
+
+def chunked(query):
+    """ Fetches the rows of a query in fixed size chunks through a server
+    side cursor, keeping memory flat no matter how many rows match """
+    chunk_size = int(current_app.config.get('stream_chunk_size', 500))
+    return query.yield_per(chunk_size)
+
+
+def render_block(block):
+    if block is None:
+        return stream_template('block.html', block=None, transactions=[])
+
+    # Filtering on height too lets postgres prune to a single partition
+    tx_query = m.Transaction.query.filter_by(block_id=block.id,
+                                             height=block.height)
+    return stream_template('block.html',
+                           block=block,
+                           tx_count=tx_query.count(),
+                           transactions=chunked(tx_query.order_by(m.Transaction.id)))
+
+
+def render_transaction(transaction):
+    if transaction is None:
+        return stream_template('transaction.html', transaction=None,
+                               spent_outputs=[], created_outputs=[])
+
+    spent = (m.Output.query.filter_by(spend_tx_id=transaction.id)
+                           .order_by(m.Output.origin_tx_hash, m.Output.index))
+    created = (m.Output.query.filter_by(origin_tx_hash=transaction.txid,
+                                        height=transaction.height)
+                             .options(joinedload('spent_tx'))
+                             .order_by(m.Output.index))
+    # Outputs pruned from the table come back unpacked from the archive. A
+    # transaction's created outputs are pruned all at once, but its inputs
+    # can be a mix of pruned and live outputs
+    archived_spent, archived_created = pruning.archived_outputs(transaction)
+    return stream_template('transaction.html',
+                           transaction=transaction,
+                           spent_outputs=heapq.merge(
+                               archived_spent, chunked(spent),
+                               key=lambda o: (o.origin_tx_hash, o.index)),
+                           created_outputs=(archived_created or
+                                            chunked(created)))
+
+
+def history_position(output):
+    return (output.height, output.origin_tx_hash, output.index)
+
+
+def format_cursor(output):
+    height, txid, index = history_position(output)
+    return "{}-{}-{}".format(height, binascii.hexlify(txid).decode('ascii'), index)
+
+
+def parse_cursor(value):
+    """ (height, txid, index) from a history page link, or None """
+    try:
+        height, txid, index = value.split('-')
+        return int(height), binascii.unhexlify(txid), int(index)
+    except (AttributeError, ValueError, TypeError, binascii.Error):
+        return None
+
+
+def address_history(address, limit, before=None, after=None):
+    """ Up to `limit` outputs paid to an address, newest first from just
+    below `before`, or oldest first from just above `after`. Pages are
+    keyed by position rather than offset, so every page reads straight off
+    the output_address_height index however deep it is """
+    position = sqlalchemy.tuple_(m.Output.height, m.Output.origin_tx_hash,
+                                 m.Output.index)
+    # The origin transaction comes along for Output.timestamp
+    live = (m.Output.query.filter_by(address_hash=address.hash)
+                          .options(joinedload('spent_tx'),
+                                   joinedload('origin_tx')))
+    if after is not None:
+        live = (live.filter(position > sqlalchemy.tuple_(*after))
+                    .order_by(m.Output.height, m.Output.origin_tx_hash,
+                              m.Output.index))
+    else:
+        if before is not None:
+            live = live.filter(position < sqlalchemy.tuple_(*before))
+        live = live.order_by(m.Output.height.desc(),
+                             m.Output.origin_tx_hash.desc(),
+                             m.Output.index.desc())
+    live = live.limit(limit).all()
+    # Pruned outputs are interleaved from the archive
+    archived = pruning.address_outputs(address.hash, limit, before, after)
+    if not archived:
+        return live
+    return list(heapq.merge(archived, live, key=history_position,
+                            reverse=after is None))[:limit]
+
+
+def render_address(address):
     outputs_per_page = int(current_app.config.get('outputs_per_page', 15))
 
-    index = int(request.args.get('index', 0))
-    if index < 0:
-        index = 0
-    offset = index * outputs_per_page
+    before = parse_cursor(request.args.get('before'))
+    after = parse_cursor(request.args.get('after'))
+    if before is not None:
+        after = None
+    # One more than a page says whether there's another in that direction
+    outputs = address_history(address, outputs_per_page + 1, before, after)
+    more = len(outputs) > outputs_per_page
+    outputs = outputs[:outputs_per_page]
+    if after is not None:
+        outputs.reverse()
+        if not more:
+            # Paged back up to the newest, which is just the first page
+            after = None
+            outputs = address_history(address, outputs_per_page + 1)
+            more = len(outputs) > outputs_per_page
+            outputs = outputs[:outputs_per_page]
+
+    newer = older = None
+    if outputs:
+        if before is not None or after is not None:
+            newer = format_cursor(outputs[0])
+        if after is not None or more:
+            older = format_cursor(outputs[-1])
+    return render_template('address.html',
+                           address_obj=address,
+                           outputs=outputs,
+                           newer=newer,
+                           older=older)
 
+
+@main.route('/address/<address>')
+def address(address):
     similar_addrs = m.Address.get_search_results(address)
     if len(similar_addrs) == 1:
-        outputs = similar_addrs[0].outputs[offset:offset + outputs_per_page]
-        return render_template('address.html',
-                               address_obj=similar_addrs[0],
-                               outputs=outputs,
-                               outputs_per_page=outputs_per_page,
-                               index=index)
+        return render_address(similar_addrs[0])
 
     return render_template('search_results.html',
                            addresses=similar_addrs)
@@ -43,14 +186,26 @@ def address(address):
 
 @main.route('/block/<hash>')
 def block(hash):
-    block = m.Block.query.filter_by(hash=core.lx(hash)).first()
-    return render_template('block.html', block=block)
+    hash = core.lx(hash)
+    if bloom.definitely_missing('block', hash):
+        return render_block(None)
+    block = m.Block.query.filter_by(hash=hash).first()
+    return render_block(block)
+
+
+@main.route('/block/height/<int:height>')
+def block_at_height(height):
+    block = m.Block.query.filter_by(height=height).first()
+    return render_block(block)
 
 
 @main.route('/transaction/<hash>')
 def transaction(hash):
-    transaction = m.Transaction.query.filter_by(txid=core.lx(hash)).first()
-    return render_template('transaction.html', transaction=transaction)
+    txid = core.lx(hash)
+    if bloom.definitely_missing('tx', txid):
+        return render_transaction(None)
+    transaction = m.Transaction.query.filter_by(txid=txid).first()
+    return render_transaction(transaction)
 
 
 @main.route("/transactions")
@@ -80,9 +235,13 @@ def blocks():
     if index < 0:
         index = 0
     offset = index * trans_per_page
-    blocks = (m.Block.query.order_by(m.Block.height.desc())
-                           .offset(offset)
-                           .limit(trans_per_page))
+    # Recent pages are served from the ring of block summaries sync keeps in
+    # redis, and only fall back to SQL for older pages
+    blocks = cache.recent_blocks(offset, trans_per_page)
+    if blocks is None:
+        blocks = (m.Block.query.order_by(m.Block.height.desc())
+                               .offset(offset)
+                               .limit(trans_per_page))
 
     return render_template('blocks.html',
                            blocks=blocks,
@@ -90,6 +249,82 @@ def blocks():
                            index=index)
 
 
+@main.route('/richlist')
+def rich_list():
+    size = int(current_app.config.get('richlist_size', 100))
+    return render_template('richlist.html',
+                           addresses=richlist.top(size),
+                           distribution=richlist.distribution())
+
+
+@main.route('/api/richlist')
+def rich_list_api():
+    size = int(current_app.config.get('richlist_size', 100))
+    limit = min(int(request.args.get('limit', size)), size)
+    offset = max(int(request.args.get('offset', 0)), 0)
+    return jsonify(addresses=[dict(rank=rank,
+                                   address=address.hash_str,
+                                   balance=str(address.balance))
+                              for rank, address in richlist.top(limit, offset)],
+                   distribution=[dict(low=str(row['low']),
+                                      high=str(row['high']),
+                                      addresses=row['addresses'],
+                                      total=str(row['total']))
+                                 for row in richlist.distribution()])
+
+
+@main.route('/api/richlist/<address>')
+def rich_list_rank(address):
+    pkhash = m.Address.format_query_str(address)
+    address_obj = None
+    if pkhash and not bloom.definitely_missing('address', pkhash):
+        address_obj = m.Address.query.filter_by(hash=pkhash).first()
+    if address_obj is None:
+        abort(404)
+    return jsonify(address=address_obj.hash_str,
+                   balance=str(address_obj.balance),
+                   rank=richlist.rank(address_obj))
+
+
+@main.route('/api/chart/<metric>')
+def chart(metric):
+    if metric not in charts.METRICS:
+        abort(404)
+    # Unix times, defaulting to the whole chain
+    end = request.args.get('end', type=int)
+    end = (datetime.datetime.utcfromtimestamp(end) if end is not None
+           else datetime.datetime.utcnow())
+    start = request.args.get('start', type=int)
+    start = (datetime.datetime.utcfromtimestamp(start) if start is not None
+             else datetime.datetime(2009, 1, 1))
+    resolution, points = charts.series(metric, start, end)
+    return jsonify(metric=metric, resolution=resolution, points=points)
+
+
+@main.route('/status')
+def status():
+    if g.sync_status is None:
+        return jsonify(synced=False, reported=False)
+
+    return jsonify(synced=g.sync_status['lag'] <= g.sync_lag_warning and
+                   g.sync_status['age'] <= g.sync_stale_seconds,
+                   reported=True,
+                   **g.sync_status)
+
+
+@main.route('/stream')
+def stream():
+    # Each client holds a connection open, which needs cooperative workers
+    if not current_app.config.get('live_feed'):
+        abort(404)
+
+    return Response(feed.event_stream(),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache',
+                             # Stop nginx from buffering the events
+                             'X-Accel-Buffering': 'no'})
+
+
 @main.route('/favicon.ico')
 def favicon():
     return send_from_directory(
@@ -99,32 +334,20 @@ def favicon():
 
 @main.route('/search/<query>')
 def search(query):
-    outputs_per_page = int(current_app.config.get('outputs_per_page', 15))
-
-    index = int(request.args.get('index', 0))
-    if index < 0:
-        index = 0
-    offset = index * outputs_per_page
-
     # Get matching addresses
     addresses = m.Address.get_search_results(query)
     if len(addresses) == 1:
-        outputs = addresses[0].outputs[offset:offset + outputs_per_page]
-        return render_template('address.html',
-                               address_obj=addresses[0],
-                               outputs=outputs,
-                               outputs_per_page=outputs_per_page,
-                               index=index)
+        return render_address(addresses[0])
 
     # Get matching transactions
     transactions = m.Transaction.get_search_results(query)
     if len(transactions) == 1:
-        return render_template('transaction.html', transaction=transactions[0])
+        return render_transaction(transactions[0])
 
     # Get matching blocks
     blocks = m.Block.get_search_results(query)
     if len(blocks) == 1:
-        return render_template('block.html', block=blocks[0])
+        return render_block(blocks[0])
 
     return render_template('search_results.html',
                            blocks=blocks,
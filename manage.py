@@ -9,7 +9,8 @@ from collections import deque
 import signal
 import sqlalchemy
 
-from lincoln import create_app, db, coinserv
+from lincoln import (create_app, db, coinserv, cache, blkfile, partitioning,
+                     bloom, pruning, richlist, charts)
 from lincoln.models import Block, Transaction, Output, Address
 
 import time
@@ -49,26 +50,46 @@ def init_db():
     db.create_all()
 
 
-@manager.command
-@crontab
-def delete_highest_block():
-    block = Block.query.order_by(Block.height.desc()).first()
-    for tx in block.transactions:
-        # Reverse spent TX output changes
-        for stxo in tx.origin_txs:
-            stxo.address.total_out -= stxo.amount
+def rollback_block(block):
+    """ Deletes the highest block, undoing everything sync did for it """
+    balances = richlist.BalanceTracker()
+    charts.remove_block(block, len(block.transactions))
+    # Newest first, so outputs spent within the block are unspent before
+    # they're deleted
+    for tx in sorted(block.transactions, key=lambda tx: tx.id, reverse=True):
+        # Unspend the outputs it spent
+        for stxo in list(tx.spent_txs):
+            if stxo.address is not None:
+                stxo.address.total_out -= stxo.amount
+                balances.credit(stxo.address, richlist.satoshis(stxo.amount))
             stxo.spent_tx = None
-        # Reverse unspent TX output changes & drop
-        for utxo in tx.spent_txs:
-            utxo.address.total_in -= utxo.amount
+        # Drop the outputs it created
+        for utxo in tx.origin_txs:
+            if utxo.address is not None:
+                utxo.address.total_in -= utxo.amount
+                balances.debit(utxo.address, richlist.satoshis(utxo.amount))
             db.session.delete(utxo)
         db.session.delete(tx)
     db.session.delete(block)
-    db.session.commit()
+    balances.flush()
+
 
 @manager.command
 @crontab
-def sync():
+def delete_highest_block():
+    block = Block.query.order_by(Block.height.desc()).first()
+    rollback_block(block)
+    db.session.commit()
+    cache.rebuild_block_ring()
+
+
+@manager.option('--blocks-dir', dest='blocks_dir', default=None,
+                help="Read blocks from the coin daemon's blk*.dat files")
+@crontab
+def sync(blocks_dir=None):
+    """ Indexes new blocks from the coin daemon. With --blocks-dir, blocks
+    are read straight from the daemon's block files and RPC is only used to
+    confirm the best chain, which makes the initial import much faster """
 
     # Kinda hacky, but simple & effective way to break loop on SIGINT
     loop = [1]
@@ -88,20 +109,25 @@ def sync():
 
     # Check for forks, but only if we're relatively sync'd up
     if highest and server_height <= highest.height + 150:
-        server_highest_hash = coinserv.getblockhash(highest.height)
-        if server_highest_hash != highest.hash:
-            # Delete blocks until we find a common ancestor
-            while True:
-                prev_height = highest.height - 1
-                second_highest = Block.query.filter_by(height=prev_height).one()
-                server_prev_hash = coinserv.getblockhash(second_highest.height)
-                db.session.delete(highest)
-                if server_prev_hash == second_highest.hash:
-                    db.session.commit()
-                    break
-                else:
-                    highest = second_highest
-
+        rolled_back = False
+        # Delete blocks until we find a common ancestor
+        while highest and coinserv.getblockhash(highest.height) != highest.hash:
+            current_app.logger.info("Rolling back orphaned block {}".format(highest))
+            rollback_block(highest)
+            db.session.commit()
+            rolled_back = True
+            highest = Block.query.order_by(Block.height.desc()).first()
+        if rolled_back:
+            cache.rebuild_block_ring()
+
+    # Let the web side know where we stand even if there's nothing to sync
+    cache.publish_sync_status(highest.height if highest else 0, server_height, 0)
+    status_at = time.time()
+
+    prune_blocks = int(current_app.config.get('prune_sync_blocks', 0) or 0)
+    block_files = None
+    if blocks_dir:
+        block_files = blkfile.open_index(blocks_dir)
 
     block_times = deque([], maxlen=1000)
     while loop:
@@ -121,7 +147,15 @@ def sync():
         else:
             curr_hash = coinserv.getblockhash(curr_height)
 
-        block = coinserv.getblock(curr_hash)
+        block = None
+        if block_files is not None:
+            prev_hash = highest.hash if highest else b'\x00' * 32
+            block = block_files.next_block(prev_hash, curr_hash)
+        # Blocks the daemon hasn't flushed to disk yet, or that aren't on
+        # the chain we've been following, come from RPC as usual
+        if block is None:
+            block = coinserv.getblock(curr_hash)
+        partitioning.ensure_partitions(db.engine, db.metadata, curr_height)
         block_obj = Block(hash=block.GetHash(),
                           height=curr_height,
                           ntime=datetime.datetime.utcfromtimestamp(block.nTime),
@@ -134,14 +168,22 @@ def sync():
         current_app.logger.debug(
             "Syncing block {}".format(block_obj))
         db.session.add(block_obj)
+        # The newest transactions of the block, for the live feed
+        feed_txs = deque([], maxlen=cache.feed_max_txs())
+        # Everything new in the block, for the negative lookup filters
+        seen = dict(block=[block_obj.hash], tx=[], address=[])
+        balances = richlist.BalanceTracker()
 
         # all TX's in block are connectable; index
         for tx in block.vtx:
             tx_obj = Transaction(block=block_obj,
+                                 height=curr_height,
+                                 ntime=block_obj.ntime,
                                  txid=tx.GetHash(),
                                  total_in=0,
                                  total_out=0)
             db.session.add(tx_obj)
+            seen['tx'].append(tx_obj.txid)
             current_app.logger.debug("Found new tx {}".format(tx_obj))
 
             for i, txout in enumerate(tx.vout):
@@ -149,6 +191,7 @@ def sync():
                 tx_obj.total_out += out_dec
 
                 out = Output(origin_tx=tx_obj,
+                             height=curr_height,
                              index=i,
                              amount=out_dec)
                 db.session.add(out)
@@ -161,11 +204,14 @@ def sync():
                     continue
 
                 addr = Address.get_addr(dest_address, addr_version)
-                if not addr.first_seen_at:
+                new_addr = not addr.first_seen_at
+                if new_addr:
                     addr.first_seen_at = tx_obj.block.ntime
+                    seen['address'].append(addr.hash)
                 out.address = addr
                 # Update address total in amount
                 addr.total_in += out.amount
+                balances.credit(addr, txout.nValue, new=new_addr)
 
             db.session.flush()
 
@@ -178,28 +224,284 @@ def sync():
                     tx_obj.total_in += obj.amount
 
                     # Update address total out amount
-                    obj.address.total_out += obj.amount
+                    if obj.address is not None:
+                        obj.address.total_out += obj.amount
+                        balances.debit(obj.address, richlist.satoshis(obj.amount))
             else:
                 tx_obj.coinbase = True
 
             # for tx in tx.vin:
             block_obj.total_in += tx_obj.total_in
             block_obj.total_out += tx_obj.total_out
+            feed_txs.append(cache.feed_tx(tx_obj))
 
         highest = block_obj
+        balances.flush()
+        charts.add_block(block_obj, len(block.vtx))
+        # Before the commit, so there's no moment where a lookup can find
+        # the block in the database but the filters still rule it out
+        bloom.add(seen)
         db.session.commit()
+        cache.push_block(block_obj, len(block.vtx))
+        cache.publish_block(block_obj, len(block.vtx), feed_txs)
+        # Pruning is normally left to manage.py prune, but can be kept pace
+        # with here a block or two at a time
+        if prune_blocks:
+            pruning.step(curr_height, prune_blocks)
 
         block_times.append(time.time() - t)
+        time_per = sum(block_times) / len(block_times)
+        # Publish progress for the status page, throttled so a fast initial
+        # sync doesn't write on every block
+        if curr_height == server_height or time.time() - status_at >= 1:
+            cache.publish_sync_status(curr_height, server_height,
+                                      1 / time_per if time_per else 0)
+            status_at = time.time()
+
         interval = 1 if current_app.log_level == logging.DEBUG else 100
         # Display progress information
         if curr_height % interval == 0:
-            time_per = sum(block_times) / len(block_times)
             time_remain = datetime.timedelta(
                 seconds=time_per * (server_height - curr_height))
             current_app.logger.info(
                 "{:,}/{:,} {} estimated to catchup"
                 .format(curr_height, server_height, time_remain))
 
+    if block_files is not None:
+        block_files.close()
+
+
+@manager.option('--height', type=int, default=None)
+@manager.option('--out', default='snapshot')
+@manager.option('--chunk-rows', dest='chunk_rows', type=int, default=1000000)
+def snapshot_export(height, out, chunk_rows):
+    """ Writes the database as of --height into the --out directory as
+    chunked gzipped csv files with a manifest. Defaults to 150 blocks below
+    the highest block, so the snapshot can't be forked off """
+    from lincoln import snapshot
+    if height is None:
+        highest = Block.query.order_by(Block.height.desc()).first()
+        height = max(highest.height - 150, 0)
+    manifest = snapshot.export(out, height, chunk_rows)
+    current_app.logger.info("Exported snapshot of {} at height {:,} to {}"
+                            .format(manifest['currency'], height, out))
+
+
+@manager.option('--path', default='snapshot')
+def snapshot_import(path):
+    """ Replaces the database with a snapshot written by snapshot_export.
+    Afterwards sync picks up from the block after the snapshot """
+    from lincoln import snapshot
+    manifest = snapshot.load(path)
+    current_app.logger.info("Imported snapshot at height {:,}, sync will "
+                            "resume from {:,}".format(manifest['height'],
+                                                      manifest['height'] + 1))
+
+
+@manager.option('--kind', action='append', dest='kinds', default=None)
+@manager.option('--workers', type=int, default=4)
+@manager.option('--chunk-size', dest='chunk_size', type=int, default=10000)
+@manager.option('--sleep', type=float, default=0)
+@manager.option('--repair', action='store_true', default=False)
+@manager.option('--restart', action='store_true', default=False)
+def audit(kinds, workers, chunk_size, sleep, repair, restart):
+    """ Recomputes the cached transaction, block and address totals in
+    parallel ranges of --chunk-size rows and reports any that have drifted,
+    fixing them with --repair. Each worker pauses --sleep seconds between
+    ranges to go easy on a live database. Resumes an interrupted audit
+    unless --restart is given """
+    from lincoln import audit as auditor
+
+    def report(result):
+        for key, field, have, want in result['examples']:
+            current_app.logger.warn(
+                "{} {} {} is {:,} satoshis, should be {:,}"
+                .format(result['kind'], key, field, have, want))
+        if result['mismatches'] > len(result['examples']):
+            current_app.logger.warn("...and {:,} more in {} {:,}-{:,}".format(
+                result['mismatches'] - len(result['examples']),
+                result['kind'], result['low'], result['high']))
+        current_app.logger.info("Audited {} {:,}-{:,}".format(
+            result['kind'], result['low'], result['high']))
+
+    summary = auditor.run(kinds or auditor.KINDS, workers, chunk_size, repair,
+                          sleep, restart, report)
+    for kind, totals in summary.items():
+        current_app.logger.info(
+            "{:<12} {checked:>12,} checked  {mismatches:>8,} mismatched  "
+            "{repaired:>8,} repaired".format(kind, **totals))
+
+
+@manager.command
+def charts_rebuild():
+    """ Recomputes the chart rollups from the blocks, for databases synced
+    before they existed """
+    charts.rebuild()
+    current_app.logger.info("Rebuilt chart rollups")
+
+
+@manager.command
+def richlist_rebuild():
+    """ Recomputes stored address balances and the balance distribution from
+    the address totals. Sync keeps them current; this is for repairs """
+    richlist.rebuild()
+    current_app.logger.info("Rebuilt balances and distribution")
+
+
+@manager.option('--blocks', type=int, default=100)
+@manager.option('--sleep', type=float, default=1.0)
+@manager.option('--follow', action='store_true', default=False)
+def prune(blocks, sleep, follow):
+    """ Works through pruning in steps of --blocks spend heights, pausing
+    --sleep seconds between them, until it reaches prune_depth below the
+    highest block. With --follow it then keeps pace with sync, which is how
+    pruning is meant to run alongside it """
+    if not pruning.depth():
+        current_app.logger.error("Set prune_depth in the config to enable pruning")
+        return
+    while True:
+        highest = Block.query.order_by(Block.height.desc()).first()
+        db.session.rollback()
+        if highest and pruning.pruned_height() < highest.height - pruning.depth():
+            pruned = pruning.step(highest.height, blocks)
+            current_app.logger.info("Pruned {:,} transactions, through spends at "
+                                    "height {:,}".format(pruned, pruning.pruned_height()))
+        elif not follow:
+            break
+        time.sleep(sleep)
+
+
+@manager.option('--kind', action='append', dest='kinds', default=None)
+@manager.option('--restart', action='store_true', default=False)
+def bloom_rebuild(kinds, restart):
+    """ Builds the negative lookup filters from the database, resuming an
+    interrupted build unless --restart is given. Lookups only use a filter
+    once its build has finished """
+    for kind in kinds or bloom.KINDS:
+        bloom.rebuild(kind, resume=not restart)
+        current_app.logger.info("Built {} bloom filter".format(kind))
+
+
+@manager.command
+def bloom_stats():
+    """ Prints the size and estimated false positive rate of each filter """
+    for kind in bloom.KINDS:
+        s = bloom.stats(kind)
+        if s is None:
+            current_app.logger.info("{:<8} not built".format(kind))
+            continue
+        current_app.logger.info(
+            "{kind:<8} {added:>12,} of {capacity:,} items  {memory_mb:,.1f}MB  "
+            "{hashes} hashes  {fill:.1%} bits set  false positives "
+            "{false_positive_rate:.4%}{status}"
+            .format(status='' if s['ready'] else '  (building)', **s))
+
+
+@manager.command
+def profile_report():
+    """ Prints the per route latency histograms recorded by profile_requests """
+    from lincoln import profiling
+    stats = profiling.route_stats()
+    for route, s in sorted(stats.items(), key=lambda r: -r[1]['avg_ms']):
+        current_app.logger.info(
+            "{route:<32} {count:>8,} reqs  p50 <={p50_ms:>5}ms  p90 <={p90_ms:>5}ms  "
+            "p99 <={p99_ms:>5}ms  avg {avg_ms:,.1f}ms (sql {avg_sql_ms:,.1f}ms, "
+            "render {avg_render_ms:,.1f}ms, {avg_queries:,.1f} queries)"
+            .format(route=route, **s))
+
+
+@manager.command
+def bench_front_page(requests=500):
+    """ Compares front page requests/sec with and without the block ring """
+    from lincoln.bench import front_page
+    results = front_page.run(int(requests))
+    for name, per_sec in sorted(results.items()):
+        current_app.logger.info("{:>5}: {:,.1f} requests/sec".format(name, per_sec))
+
+
+@manager.option('--blocks', type=int, default=500)
+@manager.option('--seed', type=int, default=1)
+@manager.option('--txs-per-block', dest='txs_per_block', default='1-50')
+@manager.option('--inputs-per-tx', dest='inputs_per_tx', default='1-3')
+@manager.option('--outputs-per-tx', dest='outputs_per_tx', default='1-4')
+@manager.option('--script-mix', dest='script_mix', default=None)
+@manager.option('--postgres', default=None)
+@manager.option('--from-files', dest='from_files', action='store_true', default=False)
+def bench_sync(blocks, seed, txs_per_block, inputs_per_tx, outputs_per_tx,
+               script_mix, postgres, from_files):
+    """ Measures sync against a synthetic chain served by a mock coin daemon.
+    Ranges are given as min-max, the script mix as p2pkh=70,p2sh=20,...
+    --postgres takes the URI of a scratch database, which gets wiped.
+    --from-files also measures syncing from blk*.dat files """
+    from lincoln.bench import sync as sync_bench
+    reports = sync_bench.run(init_db, sync,
+                             block_count=blocks,
+                             postgres=postgres,
+                             from_files=from_files,
+                             seed=seed,
+                             txs_per_block=sync_bench.parse_range(txs_per_block),
+                             inputs_per_tx=sync_bench.parse_range(inputs_per_tx),
+                             outputs_per_tx=sync_bench.parse_range(outputs_per_tx),
+                             script_mix=sync_bench.parse_mix(script_mix))
+    for r in reports:
+        current_app.logger.info(
+            "{backend:>18}: {blocks:,} blocks in {seconds:,.1f}s, "
+            "{blocks_per_sec:,.1f} blocks/sec, {rows_per_sec:,.0f} rows/sec, "
+            "{queries_per_block:,.1f} queries/block, {peak_rss_mb:,.1f}MB peak RSS"
+            .format(**r))
+
+
+@manager.option('--worker-classes', dest='worker_classes', default='sync,gevent')
+@manager.option('--workers', default='1,2,4')
+@manager.option('--concurrency', type=int, default=100)
+@manager.option('--duration', type=int, default=10)
+@manager.option('--paths', default='/,/transactions')
+def bench_serving(worker_classes, workers, concurrency, duration, paths):
+    """ Measures requests/sec against gunicorn for each worker class and
+    worker count, with --concurrency clients requesting --paths in turn """
+    from lincoln.bench import serving
+    reports = serving.run(current_app.config_path,
+                          worker_classes=worker_classes.split(','),
+                          worker_counts=[int(w) for w in workers.split(',')],
+                          concurrency=concurrency,
+                          duration=duration,
+                          paths=paths.split(','))
+    for r in reports:
+        current_app.logger.info(
+            "{worker_class:>7} x {workers:<2}: {requests_per_sec:>8,.1f} requests/sec, "
+            "p50 {p50_ms:,.1f}ms, p99 {p99_ms:,.1f}ms, {errors:,} errors "
+            "({concurrency} clients)".format(**r))
+
+
+@manager.option('--database', default=None)
+@manager.option('--reuse', action='store_true', default=False)
+@manager.option('--outputs', type=int, default=1000000)
+@manager.option('--requests', type=int, default=20)
+@manager.option('--seed', type=int, default=1)
+def bench_web(database, reuse, outputs, requests, seed):
+    """ Measures view latency over a large generated database. Without
+    --database a temporary sqlite file is used. --database is wiped and
+    repopulated unless --reuse is given, so only use a scratch database """
+    import os
+    import tempfile
+    from lincoln.bench import web
+
+    path = None
+    if database is None:
+        path = tempfile.mktemp(suffix='.sqlite', prefix='lincoln_bench_')
+        database = 'sqlite:///' + path
+    try:
+        reports = web.run(database, populate=not reuse, requests=requests,
+                          outputs=outputs, seed=seed)
+    finally:
+        if path and os.path.exists(path):
+            os.remove(path)
+
+    for r in reports:
+        current_app.logger.info(
+            "{name:>22}: p50 {p50_ms:9,.1f}ms  p99 {p99_ms:9,.1f}ms  "
+            "{queries:7,.1f} queries/request".format(**r))
+
 
 manager.add_option('-c', '--config', default='/config.yml')
 manager.add_option('-l', '--log-level',
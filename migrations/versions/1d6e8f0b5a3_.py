@@ -0,0 +1,34 @@
+"""Denormalize block time onto transaction, index output by address and height
+
+Revision ID: 1d6e8f0b5a3
+Revises: 4b1f3a2c9d7
+Create Date: 2026-10-19 11:02:17.513204
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '1d6e8f0b5a3'
+down_revision = '4b1f3a2c9d7'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # Partitioned tables take these on the parent and postgres carries them
+    # down to every partition, so both layouts upgrade the same way
+    op.add_column('transaction', sa.Column('ntime', sa.DateTime(), nullable=True))
+    op.execute('UPDATE "transaction" SET ntime = '
+               '(SELECT ntime FROM block WHERE block.id = "transaction".block_id)')
+    if op.get_bind().dialect.name == 'postgresql':
+        op.alter_column('transaction', 'ntime', nullable=False)
+    op.create_index('transaction_ntime', 'transaction', ['ntime'], unique=False)
+
+    op.create_index('output_address_height', 'output',
+                    ['address_hash', 'height', 'origin_tx_hash', 'index'],
+                    unique=False)
+    op.drop_index('ix_output_address_hash', 'output')
+
+
+def downgrade():
+    raise Exception()
@@ -0,0 +1,30 @@
+"""Add output_archive for pruned outputs
+
+Revision ID: 2c7a9e4f1b6
+Revises: 1d6e8f0b5a3
+Create Date: 2026-10-19 14:21:40.118372
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '2c7a9e4f1b6'
+down_revision = '1d6e8f0b5a3'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('output_archive',
+    sa.Column('tx_id', sa.Integer(), nullable=False),
+    sa.Column('height', sa.Integer(), nullable=False),
+    sa.Column('created', sa.LargeBinary(), nullable=True),
+    sa.Column('spent', sa.LargeBinary(), nullable=True),
+    sa.PrimaryKeyConstraint('tx_id')
+    )
+    op.create_index('output_archive_height', 'output_archive', ['height'], unique=False)
+
+
+def downgrade():
+    op.drop_index('output_archive_height', 'output_archive')
+    op.drop_table('output_archive')
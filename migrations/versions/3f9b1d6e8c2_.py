@@ -0,0 +1,33 @@
+"""Add chart_rollup
+
+Revision ID: 3f9b1d6e8c2
+Revises: 5e2d8b7c4a1
+Create Date: 2026-10-19 17:48:33.206511
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3f9b1d6e8c2'
+down_revision = '5e2d8b7c4a1'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('chart_rollup',
+    sa.Column('resolution', sa.String(length=8), nullable=False),
+    sa.Column('period', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('start', sa.DateTime(), nullable=False),
+    sa.Column('blocks', sa.Integer(), nullable=False),
+    sa.Column('difficulty', sa.Float(), nullable=False),
+    sa.Column('transactions', sa.Integer(), nullable=False),
+    sa.Column('volume', sa.BigInteger(), nullable=False),
+    sa.PrimaryKeyConstraint('resolution', 'period')
+    )
+    op.create_index('chart_rollup_start', 'chart_rollup', ['resolution', 'start'], unique=False)
+
+
+def downgrade():
+    op.drop_index('chart_rollup_start', 'chart_rollup')
+    op.drop_table('chart_rollup')
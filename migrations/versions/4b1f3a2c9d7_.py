@@ -0,0 +1,72 @@
+"""Add height to transaction and output, partitioning them on postgres
+
+Revision ID: 4b1f3a2c9d7
+Revises: 35795a8c3a4
+Create Date: 2026-10-19 10:12:41.270113
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4b1f3a2c9d7'
+down_revision = '35795a8c3a4'
+
+from alembic import op
+import sqlalchemy as sa
+
+from lincoln import partitioning
+
+
+def tables():
+    """ The partitioned tables as they stand at this revision. Later
+    revisions change the models, so they can't be built from db.metadata """
+    metadata = sa.MetaData()
+    # Only here so the foreign keys resolve
+    sa.Table('block', metadata, sa.Column('id', sa.Integer(), primary_key=True))
+    sa.Table('address', metadata, sa.Column('hash', sa.LargeBinary(), primary_key=True))
+
+    sa.Table('transaction', metadata,
+    sa.Column('id', sa.Integer(), primary_key=True),
+    sa.Column('txid', sa.LargeBinary(length=64), unique=True),
+    sa.Column('network_fee', sa.Numeric(precision=1000, scale=28)),
+    sa.Column('coinbase', sa.Boolean()),
+    sa.Column('block_id', sa.Integer(), sa.ForeignKey('block.id')),
+    sa.Column('height', sa.Integer(), nullable=False),
+    sa.Column('total_in', sa.Numeric(precision=1000, scale=28)),
+    sa.Column('total_out', sa.Numeric(precision=1000, scale=28)),
+    info={'partition_by': 'height'}
+    )
+    sa.Table('output', metadata,
+    sa.Column('type', sa.SmallInteger()),
+    sa.Column('origin_tx_hash', sa.LargeBinary(length=64),
+              sa.ForeignKey('transaction.txid'), primary_key=True, index=True),
+    sa.Column('height', sa.Integer(), nullable=False),
+    sa.Column('amount', sa.Numeric(precision=1000, scale=28)),
+    sa.Column('index', sa.SmallInteger(), primary_key=True, autoincrement=False),
+    sa.Column('address_hash', sa.LargeBinary(), sa.ForeignKey('address.hash'),
+              index=True),
+    sa.Column('spend_tx_id', sa.Integer(), sa.ForeignKey('transaction.id'),
+              index=True),
+    info={'partition_by': 'height'}
+    )
+    return metadata
+
+
+def upgrade():
+    op.add_column('transaction', sa.Column('height', sa.Integer(), nullable=True))
+    op.add_column('output', sa.Column('height', sa.Integer(), nullable=True))
+    op.execute('UPDATE "transaction" SET height = '
+               '(SELECT height FROM block WHERE block.id = "transaction".block_id)')
+    op.execute('UPDATE output SET height = '
+               '(SELECT height FROM "transaction" '
+               'WHERE "transaction".txid = output.origin_tx_hash)')
+
+    bind = op.get_bind()
+    if bind.dialect.name == 'postgresql':
+        op.alter_column('transaction', 'height', nullable=False)
+        op.alter_column('output', 'height', nullable=False)
+    if partitioning.enabled(bind):
+        partitioning.convert_tables(bind, tables())
+
+
+def downgrade():
+    raise Exception()
@@ -0,0 +1,38 @@
+"""Add stored address balance and balance_bucket for the rich list
+
+Revision ID: 5e2d8b7c4a1
+Revises: 2c7a9e4f1b6
+Create Date: 2026-10-19 16:05:12.774301
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5e2d8b7c4a1'
+down_revision = '2c7a9e4f1b6'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('address', sa.Column('balance', sa.BigInteger(), nullable=False,
+                                       server_default='0'))
+    op.execute('UPDATE address SET balance = '
+               'CAST(ROUND((total_in - total_out) * 100000000) AS BIGINT)')
+    op.create_index('address_balance', 'address', [sa.text('balance DESC')], unique=False)
+
+    op.create_table('balance_bucket',
+    sa.Column('bucket', sa.SmallInteger(), autoincrement=False, nullable=False),
+    sa.Column('addresses', sa.Integer(), nullable=False),
+    sa.Column('total', sa.BigInteger(), nullable=False),
+    sa.PrimaryKeyConstraint('bucket')
+    )
+    op.execute('INSERT INTO balance_bucket (bucket, addresses, total) '
+               'SELECT CASE WHEN balance > 0 THEN length(CAST(balance AS VARCHAR)) '
+               'ELSE 0 END AS b, count(*), sum(balance) FROM address GROUP BY b')
+
+
+def downgrade():
+    op.drop_table('balance_bucket')
+    op.drop_index('address_balance', 'address')
+    op.drop_column('address', 'balance')
@@ -0,0 +1,22 @@
+"""Index transaction by height
+
+Revision ID: 6a4c2e9f7d1
+Revises: 3f9b1d6e8c2
+Create Date: 2026-10-19 20:14:52.630917
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '6a4c2e9f7d1'
+down_revision = '3f9b1d6e8c2'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_index('transaction_height', 'transaction', ['height'], unique=False)
+
+
+def downgrade():
+    op.drop_index('transaction_height', 'transaction')
@@ -0,0 +1,44 @@
+"""Add output_archive_address so address history can list pruned outputs
+
+Revision ID: 7d3b5f1a8e4
+Revises: 6a4c2e9f7d1
+Create Date: 2026-10-19 20:41:09.558214
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '7d3b5f1a8e4'
+down_revision = '6a4c2e9f7d1'
+
+from alembic import op
+import sqlalchemy as sa
+
+from lincoln import pruning
+
+
+def upgrade():
+    table = op.create_table('output_archive_address',
+    sa.Column('address_hash', sa.LargeBinary(), nullable=False),
+    sa.Column('height', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('txid', sa.LargeBinary(length=64), nullable=False),
+    sa.Column('tx_id', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('address_hash', 'height', 'txid')
+    )
+
+    # Index what's been pruned already
+    bind = op.get_bind()
+    rows = bind.execute(
+        'SELECT output_archive.tx_id, output_archive.height, '
+        '"transaction".txid, output_archive.created FROM output_archive '
+        'JOIN "transaction" ON "transaction".id = output_archive.tx_id '
+        'WHERE output_archive.created IS NOT NULL')
+    for tx_id, height, txid, created in rows:
+        addresses = set(e[3] for e in pruning.unpack(created) if e[3])
+        if addresses:
+            op.bulk_insert(table, [dict(address_hash=address_hash,
+                                        height=height, txid=txid, tx_id=tx_id)
+                                   for address_hash in addresses])
+
+
+def downgrade():
+    op.drop_table('output_archive_address')